@@ -0,0 +1,90 @@
+"""Benchmark msg_box logging throughput: per-message open/append vs LogSink.
+
+A slow shared filesystem is approximated by wrapping open() so that each open costs a fixed metadata latency and
+each flush/close fsyncs to disk.
+
+    python benchmarks/bench_log_sink.py [--messages 2000] [--open-latency 0.0005]
+"""
+
+import argparse
+import builtins
+import os
+import sys
+import tempfile
+from time import perf_counter
+from unittest.mock import patch
+
+from snaketool_utils.cli_utils import LogSink, msg_box
+
+
+class SlowFile:
+    """File wrapper that fsyncs on every flush and close"""
+
+    def __init__(self, handle):
+        self._handle = handle
+
+    def write(self, data):
+        return self._handle.write(data)
+
+    def tell(self):
+        return self._handle.tell()
+
+    def fileno(self):
+        return self._handle.fileno()
+
+    def flush(self):
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+
+    def close(self):
+        self.flush()
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def slow_open_factory(latency):
+    def slow_open(file, mode="r", *args, **kwargs):
+        deadline = perf_counter() + latency
+        while perf_counter() < deadline:
+            pass
+        return SlowFile(builtins.open(file, mode, *args, **kwargs))
+
+    return slow_open
+
+
+def run(n_boxes, log):
+    start = perf_counter()
+    for i in range(n_boxes):
+        msg_box(f"Message {i}", errmsg="Some longer message text", log=log)
+    if isinstance(log, LogSink):
+        log.close()
+    # msg_box writes four messages per box
+    return n_boxes * 4 / (perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000, help="Number of messages to log")
+    parser.add_argument("--open-latency", type=float, default=0.0005, help="Seconds added to each open()")
+    args = parser.parse_args()
+    n_boxes = max(args.messages // 4, 1)
+
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull, patch(
+        "snaketool_utils.cli_utils.open", slow_open_factory(args.open_latency), create=True
+    ), patch.object(sys, "stderr", devnull):
+        before = run(n_boxes, os.path.join(tmp, "before.log"))
+        after = run(n_boxes, LogSink(os.path.join(tmp, "after.log")))
+        assert os.path.getsize(os.path.join(tmp, "before.log")) == os.path.getsize(os.path.join(tmp, "after.log"))
+
+    print(f"per-message open/append: {before:12.0f} messages/s")
+    print(f"LogSink:                 {after:12.0f} messages/s")
+    print(f"speedup:                 {after / before:12.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Benchmark config merging: deep copy + the original recursive merge vs copy-on-write merged_config.
+
+Callers that need to keep their defaults had to deep-copy the config before the in-place recursive merge; merged_config
+only copies the mappings along the merged paths.
+
+    python benchmarks/bench_merge.py [--max-keys 1000000]
+"""
+
+import argparse
+import collections.abc
+import copy
+from time import perf_counter
+
+from snaketool_utils.cli_utils import merged_config, recursive_merge_config
+
+
+def original_recursive_merge_config(config, overwrite_config):
+    """recursive_merge_config as it was before the iterative rewrite"""
+
+    def _update(d, u):
+        for key, value in u.items():
+            if isinstance(value, collections.abc.Mapping):
+                d[key] = _update(d.get(key, {}), value)
+            else:
+                d[key] = value
+        return d
+
+    _update(config, overwrite_config)
+
+
+def make_config(n_keys):
+    """Sample map with n_keys samples, plus a few top-level settings"""
+    return {
+        "output": "out",
+        "threads": 8,
+        "samples": {f"sample{i}": {"R1": f"reads/sample{i}_R1.fastq.gz", "R2": None} for i in range(n_keys)},
+    }
+
+
+def timeit(func, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-keys", type=int, default=10**6, help="Largest number of sample keys to benchmark")
+    args = parser.parse_args()
+
+    overwrite = {"output": "new_out", "threads": 16, "samples": {"sample0": {"R2": "reads/sample0_R2.fastq.gz"}}}
+    print(f"{'keys':>10} {'deepcopy+original (s)':>22} {'recursive (s)':>14} {'merged_config (s)':>17} {'speedup':>8}")
+    n_keys = 10**3
+    while n_keys <= args.max_keys:
+        config = make_config(n_keys)
+        repeat = 1 if n_keys >= 10**5 else 3
+
+        def baseline():
+            original_recursive_merge_config(copy.deepcopy(config), overwrite)
+
+        def iterative():
+            recursive_merge_config(copy.deepcopy(config), overwrite)
+
+        before = timeit(baseline, repeat)
+        inplace = timeit(iterative, repeat)
+        after = timeit(lambda: merged_config(config, overwrite), repeat)
+        print(f"{n_keys:>10} {before:>22.4f} {inplace:>14.4f} {after:>17.4f} {before / after:>7.0f}x")
+        n_keys *= 10
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""Benchmark the cli_utils hot paths at several config scales, with machine-readable results for comparing commits.
+
+Synthetic configs of 10 to --max-keys keys are generated in two shapes: "wide" (a flat map of samples) and "deep"
+(the keys spread over nested maps). read_config, write_config, recursive_merge_config, merged_config, tuple_to_list and
+config_fingerprint are timed at each scale, msg is timed for throughput, and run_snakemake is timed end to end with a
+stub snakemake on PATH, so launcher overhead is measured without Snakemake installed. Each timing is the best of
+repeats taking at least --min-time seconds in total (at least 3 repeats, unless one repeat takes over 5 seconds).
+
+    python benchmarks/bench_suite.py [--max-keys 1000000] [--output results.json]
+    python benchmarks/bench_suite.py --output new.json --baseline old.json [--threshold 0.2]
+    python benchmarks/bench_suite.py --compare old.json new.json [--threshold 0.2]
+
+With --baseline or --compare, benchmarks more than --threshold slower than the baseline (and by more than
+--min-seconds) are reported and the exit code is 1.
+"""
+
+import argparse
+import copy
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from contextlib import contextmanager
+from time import perf_counter, strftime
+from unittest.mock import patch
+
+import snaketool_utils.cli_utils as cli_utils
+
+STUB_SNAKEMAKE = "#!/bin/sh\nexit 0\n"
+DEEP_LEVELS = 50
+
+
+def make_config(n_keys, shape):
+    """Synthetic config with n_keys keys in total
+
+    Args:
+        n_keys (int): Number of keys
+        shape (str): "wide" for a flat map of samples, or "deep" for keys spread over DEEP_LEVELS nested maps
+
+    Returns (dict): Config dictionary
+    """
+    if shape == "wide":
+        config = {"output": "out", "threads": 8, "samples": {}}
+        for i in range(max(n_keys - 3, 1)):
+            config["samples"][f"sample{i}"] = f"reads/sample{i}_R1.fastq.gz"
+        return config
+    levels = min(DEEP_LEVELS, n_keys)
+    per_level = max(n_keys // levels - 1, 1)
+    config = level = {}
+    for depth in range(levels):
+        for i in range(per_level):
+            level[f"key{depth}_{i}"] = ["value", i, i % 2 == 0] if i % 10 == 0 else f"value{i}"
+        level["nested"] = level = {}
+    return config
+
+
+def make_overwrite(config):
+    """Overwrite config changing about 10% of config's leaves, with tuples like click options produce"""
+    overwrite = {}
+    stack = [(config, overwrite)]
+    while stack:
+        source, target = stack.pop()
+        for index, (key, value) in enumerate(source.items()):
+            if isinstance(value, dict):
+                target[key] = {}
+                stack.append((value, target[key]))
+            elif index % 10 == 0:
+                target[key] = ("new", index)
+    return overwrite
+
+
+MIN_TIME = 0.5
+
+
+def best_of(func, setup=None, max_repeat=1000):
+    """Best time of repeated calls to func, calling setup (untimed) before each and passing func its result"""
+    best = float("inf")
+    total = 0.0
+    for count in range(1, max_repeat + 1):
+        args = (setup(),) if setup else ()
+        start = perf_counter()
+        func(*args)
+        elapsed = perf_counter() - start
+        best = min(best, elapsed)
+        total += elapsed
+        if total >= MIN_TIME and (count >= 3 or total >= 5):
+            break
+    return best
+
+
+@contextmanager
+def quiet():
+    """Send STDOUT and STDERR, including subprocesses', to /dev/null"""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), 1)
+        os.dup2(devnull.fileno(), 2)
+        try:
+            with patch.object(sys, "stdout", devnull), patch.object(sys, "stderr", devnull):
+                yield
+        finally:
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+
+
+def bench_scale(n_keys, shape, tmp, results):
+    """Time the config functions and run_snakemake for one config scale and shape (call with output quietened)"""
+    config = make_config(n_keys, shape)
+    overwrite = make_overwrite(config)
+    system_config = os.path.join(tmp, f"system_{shape}_{n_keys}.yaml")
+    cli_utils.write_config(config, system_config)
+    name = f"{shape}/{n_keys}"
+
+    results[f"read_config/{name}"] = best_of(lambda: cli_utils.read_config(system_config))
+    results[f"write_config/{name}"] = best_of(lambda: cli_utils.write_config(config, os.path.join(tmp, "written.yaml")))
+    results[f"recursive_merge_config/{name}"] = best_of(
+        lambda base: cli_utils.recursive_merge_config(base, overwrite), setup=lambda: copy.deepcopy(config)
+    )
+    results[f"merged_config/{name}"] = best_of(lambda: cli_utils.merged_config(config, overwrite))
+    with_tuples = cli_utils.merged_config(config, overwrite)
+    results[f"tuple_to_list/{name}"] = best_of(lambda: cli_utils.tuple_to_list(with_tuples))
+    results[f"config_fingerprint/{name}"] = best_of(lambda: cli_utils.config_fingerprint(config))
+
+    # end to end: copy the system config with merged values, display it, and launch the stub snakemake
+    configfile = os.path.join(tmp, "run", "config.yaml")
+
+    def fresh_run():
+        for file in (configfile, cli_utils.lock_path(configfile)):
+            if os.path.exists(file):
+                os.remove(file)
+
+    def launch(_):
+        cli_utils.run_snakemake(
+            configfile=configfile,
+            system_config=system_config,
+            snakefile_path="Snakefile",
+            merge_config={"output": "new_out"},
+        )
+
+    results[f"run_snakemake/{name}"] = best_of(launch, setup=fresh_run)
+
+
+def bench_msg(tmp, results, messages=10000):
+    """Time msg throughput to the terminal and to a log file"""
+    log = os.path.join(tmp, "bench.log")
+    with quiet():
+        results["msg/no_log"] = best_of(lambda: [cli_utils.msg("message") for _ in range(messages)]) / messages
+        results["msg/log_file"] = (
+            best_of(lambda: [cli_utils.msg("message", log=log) for _ in range(messages)]) / messages
+        )
+
+        def to_sink():
+            with cli_utils.LogSink(log) as sink:
+                for _ in range(messages):
+                    cli_utils.msg("message", log=sink)
+
+        results["msg/log_sink"] = best_of(to_sink) / messages
+
+
+def bench_stub(tmp, results):
+    """Time launching the stub snakemake directly, the floor for run_snakemake"""
+    results["stub_snakemake/launch"] = best_of(lambda: subprocess.run(["snakemake"]))
+
+
+def metadata():
+    """Describe the commit and environment the benchmarks ran in"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except FileNotFoundError:
+        commit = ""
+    loader, _ = cli_utils.yaml_backend()
+    return {
+        "commit": commit or None,
+        "timestamp": strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "yaml_loader": loader.__name__,
+    }
+
+
+def compare(baseline, current, threshold, min_seconds):
+    """Print the change in each benchmark, and return the names of those that regressed"""
+    regressions = []
+    print(f"{'benchmark':<40} {'baseline (s)':>14} {'current (s)':>14} {'change':>8}")
+    for name in sorted(set(baseline["results"]) & set(current["results"])):
+        before, after = baseline["results"][name], current["results"][name]
+        change = after / before - 1 if before else 0.0
+        regressed = change > threshold and after - before > min_seconds
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<40} {before:>14.6f} {after:>14.6f} {change:>+7.0%}{'  REGRESSION' if regressed else ''}")
+    for name in sorted(set(baseline["results"]) ^ set(current["results"])):
+        print(f"{name:<40} only in {'baseline' if name in baseline['results'] else 'current'} results")
+    return regressions
+
+
+def main():
+    global MIN_TIME
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-keys", type=int, default=10**6, help="Largest number of config keys to benchmark")
+    parser.add_argument("--shapes", default="wide,deep", help="Comma-separated config shapes: wide, deep")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare the results to this JSON file from an earlier run")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="Only compare two result files")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Fractional slowdown counted as a regression")
+    parser.add_argument("--min-seconds", type=float, default=1e-4, help="Ignore slowdowns smaller than this")
+    parser.add_argument("--min-time", type=float, default=MIN_TIME, help="Minimum total seconds to time each benchmark")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as a, open(args.compare[1]) as b:
+            regressions = compare(json.load(a), json.load(b), args.threshold, args.min_seconds)
+        sys.exit(1 if regressions else 0)
+
+    MIN_TIME = args.min_time
+
+    # measure the functions themselves, not the persistent config cache or the structured log format
+    for variable in ("SNAKETOOL_CONFIG_CACHE", "SNAKETOOL_LOG_FORMAT", "SNAKETOOL_PROFILE"):
+        os.environ.pop(variable, None)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        bin_dir = os.path.join(tmp, "bin")
+        os.mkdir(bin_dir)
+        with open(os.path.join(bin_dir, "snakemake"), "w") as stub:
+            stub.write(STUB_SNAKEMAKE)
+        os.chmod(os.path.join(bin_dir, "snakemake"), 0o755)
+        os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+        bench_stub(tmp, results)
+        bench_msg(tmp, results)
+        for shape in args.shapes.split(","):
+            n_keys = 10
+            while n_keys <= args.max_keys:
+                with quiet():
+                    bench_scale(n_keys, shape, tmp, results)
+                print(f"{shape:>5} {n_keys:>8} keys: run_snakemake {results[f'run_snakemake/{shape}/{n_keys}']:.4f}s")
+                n_keys *= 10
+
+    current = {"meta": metadata(), "results": results}
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(current, stream, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(current, indent=2, sort_keys=True))
+    if args.baseline:
+        with open(args.baseline) as stream:
+            regressions = compare(json.load(stream), current, args.threshold, args.min_seconds)
+        if regressions:
+            print(f"{len(regressions)} benchmarks regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,18 @@
 import sys
 import os
-import subprocess
-import yaml
+import atexit
+import codecs
+import functools
+import importlib
+import threading
 import click
+import collections
 import collections.abc
-from shutil import copyfile
-from time import localtime, strftime
+from contextlib import contextmanager
+from time import localtime, strftime, monotonic, time
+
+# Heavier dependencies (yaml, subprocess, asyncio, etc.) are imported in the functions that use them, so that CLIs
+# only needing msg, msg_box or OrderedCommands start quickly.
 
 
 class OrderedCommands(click.Group):
@@ -15,38 +22,503 @@ class OrderedCommands(click.Group):
         return list(self.commands)
 
 
-def echo_click(msg, log=None):
+class LazyOrderedCommands(OrderedCommands):
+    """OrderedCommands that only imports subcommands when they are invoked or their help is requested
+
+    Lazy subcommands are listed first, in the order given, followed by any commands added with add_command. Give a
+    short help string with each lazy subcommand so that the group's --help and shell completion don't need to import
+    it.
+
+    Args:
+        lazy_subcommands (dict): Ordered mapping of command name to "module:attr" import path, or to a tuple of
+            ("module:attr", "short help")
+        *args: Arguments for click.Group
+        **kwargs: Keyword arguments for click.Group
+    """
+
+    def __init__(self, *args, lazy_subcommands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands = dict(lazy_subcommands or {})
+
+    def list_commands(self, ctx: click.Context):
+        return list(self.lazy_subcommands) + [name for name in self.commands if name not in self.lazy_subcommands]
+
+    def get_command(self, ctx: click.Context, cmd_name):
+        if cmd_name in self.lazy_subcommands and cmd_name not in self.commands:
+            self.commands[cmd_name] = self._load_command(cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def _load_command(self, cmd_name):
+        import_path = self.lazy_subcommands[cmd_name]
+        if isinstance(import_path, tuple):
+            import_path = import_path[0]
+        module_name, attr = import_path.split(":", 1)
+        command = getattr(importlib.import_module(module_name), attr)
+        if not isinstance(command, click.Command):
+            raise ValueError(f"Lazy subcommand {cmd_name} ({import_path}) is not a click command")
+        return command
+
+    def _short_help(self, ctx, cmd_name, limit=45):
+        """Short help for a subcommand, without importing it if it is lazy and has a help string"""
+        if cmd_name not in self.commands and isinstance(self.lazy_subcommands.get(cmd_name), tuple):
+            return click.Command(cmd_name, help=self.lazy_subcommands[cmd_name][1]).get_short_help_str(limit)
+        command = self.get_command(ctx, cmd_name)
+        if command is None or command.hidden:
+            return None
+        return command.get_short_help_str(limit)
+
+    def format_commands(self, ctx: click.Context, formatter):
+        names = self.list_commands(ctx)
+        if not names:
+            return
+        limit = formatter.width - 6 - max(len(name) for name in names)
+        rows = [(name, self._short_help(ctx, name, limit)) for name in names]
+        rows = [row for row in rows if row[1] is not None]
+        if rows:
+            with formatter.section("Commands"):
+                formatter.write_dl(rows)
+
+    def shell_complete(self, ctx: click.Context, incomplete):
+        from click.shell_completion import CompletionItem
+
+        results = []
+        for name in self.list_commands(ctx):
+            if name.startswith(incomplete):
+                short_help = self._short_help(ctx, name)
+                if short_help is not None:
+                    results.append(CompletionItem(name, help=short_help))
+        # skip click.Group.shell_complete, which loads every subcommand, and just complete options
+        results.extend(click.Command.shell_complete(self, ctx, incomplete))
+        return results
+
+
+def _profiled_call(func, args, kwargs, modes):
+    """Call func under cProfile and/or tracemalloc, writing the profiles to files and summarising them with msg_box"""
+    # profiling modules are only imported when profiling is enabled
+    import cProfile
+    import io
+    import pstats
+    import tracemalloc
+
+    modes = {mode.strip().lower() for mode in modes.split(",")}
+    if modes & {"1", "true", "all"}:
+        modes |= {"cpu", "memory"}
+    if not modes & {"cpu", "memory"}:
+        raise ValueError(f"Unknown SNAKETOOL_PROFILE {','.join(modes)}, must be cpu, memory, or all")
+    prefix = os.environ.get("SNAKETOOL_PROFILE_OUTPUT", f"{func.__name__}_profile")
+    top = int(os.environ.get("SNAKETOOL_PROFILE_TOP", 20))
+    profiler = cProfile.Profile() if "cpu" in modes else None
+    if "memory" in modes:
+        tracemalloc.start()
+    try:
+        if profiler:
+            profiler.enable()
+        return func(*args, **kwargs)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(prefix + ".prof")
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(top)
+            msg_box(f"CPU profile written to {prefix}.prof", errmsg=summary.getvalue().strip())
+        if "memory" in modes:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            stats = snapshot.statistics("lineno")
+            with open(prefix + ".memory.txt", "w") as stream:
+                stream.write(f"Peak traced memory: {peak} bytes\n")
+                stream.writelines(f"{stat}\n" for stat in stats)
+            summary = "\n".join([f"Peak traced memory: {peak / 2**20:.1f} MiB"] + [str(stat) for stat in stats[:top]])
+            msg_box(f"Memory profile written to {prefix}.memory.txt", errmsg=summary)
+
+
+def profile_command(func):
+    """Decorator to profile a click command when the SNAKETOOL_PROFILE environment variable is set
+
+    SNAKETOOL_PROFILE=cpu runs the command under cProfile, =memory under tracemalloc, or =all for both. Profiles are
+    written to $SNAKETOOL_PROFILE_OUTPUT.prof and .memory.txt (default prefix: <command>_profile), and the top
+    $SNAKETOOL_PROFILE_TOP (default 20) entries are printed with msg_box. When SNAKETOOL_PROFILE is not set the
+    command is called directly.
+
+    Apply it below @click.command(), or to an existing click.Command.
+
+    Args:
+        func (function | click.Command): Command callback or click command to profile
+
+    Returns (function | click.Command): Wrapped callback or command
+    """
+    if isinstance(func, click.Command):
+        func.callback = profile_command(func.callback)
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        modes = os.environ.get("SNAKETOOL_PROFILE")
+        if not modes:
+            return func(*args, **kwargs)
+        return _profiled_call(func, args, kwargs, modes)
+
+    return wrapper
+
+
+class LogSink:
+    """Keep a log file open and buffer writes, rather than re-opening the log for every message.
+
+    Pass a LogSink as the log= argument to msg, msg_box, echo_click, etc. Buffered messages are written when
+    flush_size characters have accumulated, by a timer thread at most flush_interval seconds after the last flush (so
+    they reach the log even if nothing else is written), and when the sink is closed, exits its context, or the
+    interpreter exits. The log is rotated (see rotate_log) when a flush takes it past max_bytes, and is reopened if
+    another process has rotated it.
+
+    Args:
+        file (str): Filepath to log file for appending
+        flush_interval (float): Maximum seconds to hold buffered messages before writing
+        flush_size (int): Maximum number of buffered characters before writing
+        structured (bool): Write messages as JSON lines (see log_event), defaults to the SNAKETOOL_LOG_FORMAT
+            environment variable
+        max_bytes (int): Size to rotate the log at, defaults to the SNAKETOOL_LOG_MAX_BYTES environment variable
+    """
+
+    def __init__(self, file, flush_interval=1.0, flush_size=65536, structured=None, max_bytes=None):
+        self.file = file
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.structured = structured
+        self.max_bytes = _log_max_bytes() if max_bytes is None else max_bytes
+        self._handle = None
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = monotonic()
+        self._lock = threading.RLock()
+        self._timer = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __fspath__(self):
+        return os.fspath(self.file)
+
+    @property
+    def closed(self):
+        return self._handle is None
+
+    def open(self):
+        """Open the log file for appending (called automatically on first write)"""
+        with self._lock:
+            if self._handle is None:
+                self._handle = open(self.file, "a")
+                self._last_flush = monotonic()
+                atexit.register(self.close)
+        return self
+
+    def write(self, msg):
+        """Buffer a message for the log file, writing the buffer out if it is due
+
+        Args:
+            msg (str): Message to write
+        """
+        with self._lock:
+            if self._handle is None:
+                self.open()
+            self._buffer.append(msg)
+            self._buffered += len(msg)
+            due = self.flush_interval - (monotonic() - self._last_flush)
+            if self._buffered >= self.flush_size or due <= 0:
+                self.flush()
+            elif self._timer is None or not self._timer.is_alive():
+                self._timer = threading.Timer(due, self._timed_flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _timed_flush(self):
+        with self._lock:
+            if self._timer is threading.current_thread():
+                self._timer = None
+            self.flush()
+
+    def flush(self):
+        """Write any buffered messages to the log file"""
+        with self._lock:
+            if self._timer is not None and self._timer is not threading.current_thread():
+                self._timer.cancel()
+                self._timer = None
+            if self._handle is None:
+                return
+            if self._buffer:
+                if self._rotated():
+                    self._handle.close()
+                    self._handle = open(self.file, "a")
+                self._handle.write("".join(self._buffer))
+                self._buffer = []
+                self._buffered = 0
+            self._handle.flush()
+            self._last_flush = monotonic()
+            if self.max_bytes and self._handle.tell() >= self.max_bytes:
+                self._handle.close()
+                rotate_log(self.file, max_bytes=self.max_bytes)
+                self._handle = open(self.file, "a")
+
+    def _rotated(self):
+        """Whether the log file has been moved or replaced since it was opened"""
+        try:
+            return os.stat(self.file).st_ino != os.fstat(self._handle.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def close(self):
+        """Flush buffered messages and close the log file"""
+        with self._lock:
+            if self._handle is None:
+                return
+            self.flush()
+            self._handle.close()
+            self._handle = None
+            atexit.unregister(self.close)
+
+
+def _log_max_bytes():
+    """Log rotation size from the SNAKETOOL_LOG_MAX_BYTES environment variable, or None"""
+    max_bytes = os.environ.get("SNAKETOOL_LOG_MAX_BYTES")
+    return int(max_bytes) if max_bytes else None
+
+
+def log_segments(file):
+    """Find the rotated segments of a log file
+
+    Args:
+        file (str): Filepath of log file
+
+    Returns (list): Filepaths of rotated segments, oldest first
+    """
+    import re
+
+    directory, name = os.path.split(os.path.abspath(os.fspath(file)))
+    pattern = re.compile(re.escape(name) + r"\.(\d{8}-\d{6}\.\d{6})(?:\.gz)?$")
+    segments = []
+    for entry in os.listdir(directory):
+        match = pattern.match(entry)
+        if match:
+            segments.append((match[1], entry.endswith(".gz"), os.path.join(directory, entry)))
+    return [path for _, _, path in sorted(segments)]
+
+
+def _compress_log_segment(segment):
+    """gzip a rotated log segment, replacing it with segment.gz"""
+    import gzip
+    from shutil import copyfileobj
+
+    try:
+        with open(segment, "rb") as src, atomic_write(segment + ".gz", "wb") as dst:
+            with gzip.GzipFile(filename=os.path.basename(segment), mode="wb", fileobj=dst) as compressed:
+                copyfileobj(src, compressed)
+        os.unlink(segment)
+    except FileNotFoundError:
+        # already removed by another process keeping to the retention count
+        pass
+
+
+def rotate_log(file, max_bytes=None, keep=None, compress=None, background=True):
+    """Move a log file aside to a timestamped segment, so the log starts afresh
+
+    Segments are named FILE.YYYYmmdd-HHMMSS.micros (.gz when compressed), so segments from concurrent processes never
+    collide, and only the newest keep segments are kept. Rotation holds the log's lock (see config_lock), and with
+    max_bytes the size is checked again under the lock, so when several processes find the log too big only one
+    rotates it. Processes appending to the log by filepath, or with a LogSink, carry on in the new log file.
+
+    Args:
+        file (str): Filepath of log file
+        max_bytes (int): Only rotate the log if it is at least this size
+        keep (int): Number of rotated segments to keep, defaults to the SNAKETOOL_LOG_KEEP environment variable, or 5
+        compress (bool): gzip the rotated segment, defaults to the SNAKETOOL_LOG_COMPRESS environment variable
+        background (bool): Compress the segment on a background thread, rather than before returning
+
+    Returns (str): Filepath of the new segment (before compression), or None if the log wasn't rotated
+    """
+    file = os.fspath(file)
+    if keep is None:
+        keep = int(os.environ.get("SNAKETOOL_LOG_KEEP", 5))
+    if compress is None:
+        compress = os.environ.get("SNAKETOOL_LOG_COMPRESS", "").lower() in ("1", "true", "yes")
+    with config_lock(file):
+        try:
+            size = os.path.getsize(file)
+        except FileNotFoundError:
+            return None
+        if size == 0 or (max_bytes is not None and size < max_bytes):
+            return None
+        now = time()
+        segment = f"{file}.{strftime('%Y%m%d-%H%M%S', localtime(now))}.{int(now * 1e6) % 1000000:06d}"
+        os.replace(file, segment)
+
+        # keep the newest segments, counting a segment and its compressed copy once
+        stamps = {}
+        for path in log_segments(file):
+            stamps.setdefault(path[: -len(".gz")] if path.endswith(".gz") else path, []).append(path)
+        for stamp in list(stamps)[: max(len(stamps) - keep, 0)]:
+            for path in stamps[stamp]:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+    if compress and os.path.exists(segment):
+        if background:
+            # not a daemon thread, so the interpreter waits for compression to finish before exiting
+            threading.Thread(target=_compress_log_segment, args=(segment,), name="compress-log").start()
+        else:
+            _compress_log_segment(segment)
+    return segment
+
+
+def _structured(log):
+    """Whether messages for log are written as JSON lines, rather than as text"""
+    structured = getattr(log, "structured", None)
+    if structured is None:
+        return os.environ.get("SNAKETOOL_LOG_FORMAT", "text").lower() == "json"
+    return structured
+
+
+_timestamp_cache = (None, "", "", "")
+
+
+def _timestamps(now):
+    """Text and ISO 8601 timestamps for now, only calling strftime once per second"""
+    global _timestamp_cache
+    second = int(now)
+    cached = _timestamp_cache
+    if cached[0] != second:
+        local = localtime(second)
+        zone = strftime("%z", local)
+        cached = (
+            second,
+            strftime("[%Y:%m:%d %H:%M:%S] ", local),
+            strftime("%Y-%m-%dT%H:%M:%S", local),
+            f"{zone[:3]}:{zone[3:]}" if zone else "",
+        )
+        _timestamp_cache = cached
+    return cached[1], f"{cached[2]}.{int((now - second) * 1000):03d}{cached[3]}"
+
+
+_run_id = None
+
+
+def run_id():
+    """Identifier for this run in structured logs
+
+    Returns (str): The SNAKETOOL_RUN_ID environment variable, or an id generated once per process
+    """
+    global _run_id
+    if os.environ.get("SNAKETOOL_RUN_ID"):
+        return os.environ["SNAKETOOL_RUN_ID"]
+    if _run_id is None:
+        import uuid
+
+        _run_id = uuid.uuid4().hex[:16]
+    return _run_id
+
+
+def _write_log(text, log):
+    """Append text to a log file or LogSink, rotating a log file that has reached SNAKETOOL_LOG_MAX_BYTES"""
+    if isinstance(log, LogSink):
+        log.write(text)
+        return
+    with open(log, "a") as l:
+        l.write(text)
+        size = l.tell()
+    max_bytes = _log_max_bytes()
+    if max_bytes and size >= max_bytes:
+        rotate_log(log, max_bytes=max_bytes)
+
+
+def log_event(message, log=None, level="INFO", event="message", now=None, **fields):
+    """Write an event to the log as a JSON object on one line
+
+    Each event has a timestamp, level, event type, message and run id (see run_id), plus any extra fields.
+
+    Args:
+        message (str): Message for the event
+        log (str | LogSink): Filepath to log file, or LogSink, for writing
+        level (str): Level of the event, e.g. INFO or ERROR
+        event (str): Type of event, e.g. message or output
+        now (float): Time of the event in seconds since the epoch, defaults to now
+        **fields: Extra fields for the event, e.g. the Snakemake command or config filepath
+    """
+    import json
+
+    if not log:
+        return
+    _, timestamp = _timestamps(time() if now is None else now)
+    record = {"timestamp": timestamp, "level": level, "event": event, "message": message, "run_id": run_id()}
+    record.update(fields)
+    _write_log(json.dumps(record, default=str) + "\n", log)
+
+
+def echo_click(msg, log=None, level="INFO", event="output", **fields):
     """Print Error message to STDERR and copy to log file
 
     Args:
         msg (str): Error message to print
-        log (srt): Filepath to log file for writing
+        log (str | LogSink): Filepath to log file, or LogSink, for writing
+        level (str): Level of the event in structured logs
+        event (str): Type of event in structured logs
+        **fields: Extra fields for the event in structured logs
     """
     click.echo(msg, nl=False, err=True)
-    if log:
-        with open(log, "a") as l:
-            l.write(msg)
+    if not log:
+        return
+    if _structured(log):
+        log_event(msg.rstrip("\n"), log=log, level=level, event=event, **fields)
+    else:
+        _write_log(msg, log)
 
 
-def msg(err_message, log=None):
+def msg(err_message, log=None, level=None, event="message", **fields):
     """Format error message for printing
 
     Args:
         err_message (str): Error message to print
-        log (str): Filepath to log file for writing
+        log (str | LogSink): Filepath to log file, or LogSink, for writing
+        level (str): Level of the event in structured logs, defaults to ERROR for messages starting with ERROR,
+            otherwise INFO
+        event (str): Type of event in structured logs
+        **fields: Extra fields for the event in structured logs
     """
-    tstamp = strftime("[%Y:%m:%d %H:%M:%S] ", localtime())
-    echo_click(tstamp + err_message + "\n", log=log)
+    now = time()
+    tstamp, _ = _timestamps(now)
+    click.echo(tstamp + err_message + "\n", nl=False, err=True)
+    if not log:
+        return
+    if level is None:
+        level = "ERROR" if err_message.startswith("ERROR") else "INFO"
+    if _structured(log):
+        log_event(err_message, log=log, level=level, event=event, now=now, **fields)
+    else:
+        _write_log(tstamp + err_message + "\n", log)
 
 
-def msg_box(splash, errmsg=None, log=None):
+def msg_box(splash, errmsg=None, log=None, level="INFO", event="message", **fields):
     """Fancy formatting and multi-line error message for printing
 
+    In structured logs the box is a single event, with errmsg in its detail field.
+
     Args:
         splash (str): Short splash message to appear in box
         errmsg (str): Long error message to print
-        log (str): Filepath to log file for writing
+        log (str | LogSink): Filepath to log file, or LogSink, for writing
+        level (str): Level of the event in structured logs
+        event (str): Type of event in structured logs
+        **fields: Extra fields for the event in structured logs
     """
+    if log and _structured(log):
+        msg_box(splash, errmsg=errmsg)
+        if errmsg:
+            fields["detail"] = errmsg
+        log_event(splash, log=log, level=level, event=event, **fields)
+        return
     msg("-" * (len(splash) + 4), log=log)
     msg(f"| {splash} |", log=log)
     msg(("-" * (len(splash) + 4)), log=log)
@@ -54,61 +526,522 @@ def msg_box(splash, errmsg=None, log=None):
         echo_click("\n" + errmsg + "\n", log=log)
 
 
+def yaml_backend(backend=None):
+    """Get the PyYAML Loader and Dumper classes to use for reading and writing config files
+
+    The LibYAML-backed CSafeLoader/CSafeDumper are used when PyYAML was built with LibYAML, otherwise the pure-Python
+    SafeLoader/SafeDumper. Force either with the SNAKETOOL_YAML_BACKEND environment variable.
+
+    Args:
+        backend (str): "auto", "libyaml", or "python" (default: $SNAKETOOL_YAML_BACKEND or "auto")
+
+    Returns (tuple): Loader class, Dumper class
+    """
+    import yaml
+
+    if backend is None:
+        backend = os.environ.get("SNAKETOOL_YAML_BACKEND", "auto")
+    if backend not in ("auto", "libyaml", "python"):
+        raise ValueError(f"Unknown YAML backend {backend}, must be one of auto, libyaml, python")
+    if backend == "libyaml" and not yaml.__with_libyaml__:
+        raise ImportError("YAML backend libyaml requested but PyYAML was not built with LibYAML")
+    if backend != "python" and yaml.__with_libyaml__:
+        return yaml.CSafeLoader, yaml.CSafeDumper
+    return yaml.SafeLoader, yaml.SafeDumper
+
+
+@functools.lru_cache(maxsize=None)
+def _config_dumper_class(base):
+    """Subclass of a PyYAML Dumper that represents tuples, paths and enums"""
+    import enum
+    import pathlib
+
+    class ConfigDumper(base):
+        pass
+
+    ConfigDumper.add_representer(tuple, base.represent_list)
+    ConfigDumper.add_multi_representer(pathlib.PurePath, lambda dumper, path: dumper.represent_str(os.fspath(path)))
+    ConfigDumper.add_multi_representer(enum.Enum, lambda dumper, member: dumper.represent_data(member.name))
+    ConfigDumper.add_representer(SampleTable, lambda dumper, table: dumper.represent_str(table.path))
+    return ConfigDumper
+
+
+def config_dumper(backend=None):
+    """Get the safe PyYAML Dumper class for writing configs, which also dumps the types click options produce
+
+    Tuples (from multiple=True options) are written as YAML sequences, pathlib paths and SampleTables as strings, and
+    enum members (from Choice options) as their names, while serialising, so configs don't need to be copied to convert
+    them first.
+
+    Args:
+        backend (str): "auto", "libyaml", or "python", see yaml_backend
+
+    Returns (type): Dumper class
+    """
+    return _config_dumper_class(yaml_backend(backend)[1])
+
+
+class ConfigCache:
+    """Persistent on-disk cache of parsed config files, shared between snaketool invocations.
+
+    Parsed configs are pickled to the cache directory, keyed on the config file's real path, size, mtime and a hash of
+    its contents, so any change to the YAML is a cache miss. Entries are published atomically (write to a temp file
+    then rename) so concurrent readers never see a partial entry, and the least recently used entries are evicted once
+    the cache exceeds max_bytes. Enable it for read_config by setting the SNAKETOOL_CONFIG_CACHE environment variable
+    to a cache directory (and optionally SNAKETOOL_CONFIG_CACHE_SIZE to the size limit in bytes). Entries are
+    unpickled on read, so the cache directory must only be writable by trusted users.
+
+    Args:
+        directory (str): Directory for cache entries (created if missing)
+        max_bytes (int): Maximum total size of cache entries
+    """
+
+    suffix = ".pickle"
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def from_env(cls):
+        """Get the ConfigCache configured by the environment, or None if caching is not enabled"""
+        directory = os.environ.get("SNAKETOOL_CONFIG_CACHE")
+        if not directory:
+            return None
+        max_bytes = os.environ.get("SNAKETOOL_CONFIG_CACHE_SIZE")
+        if max_bytes:
+            return cls(directory, max_bytes=int(max_bytes))
+        return cls(directory)
+
+    def read_config(self, file, loader):
+        """Read a config file, using the cached parse if the file is unchanged
+
+        Args:
+            file (str): Filepath to config YAML file for reading
+            loader (yaml.Loader): PyYAML Loader class for parsing on a cache miss
+
+        Returns (dict): Config read from YAML file
+        """
+        import hashlib
+        import pickle
+        import yaml
+
+        with open(file, "rb") as stream:
+            stat = os.fstat(stream.fileno())
+            data = stream.read()
+        key = hashlib.sha256(
+            "\0".join(
+                (os.path.realpath(file), str(stat.st_size), str(stat.st_mtime_ns), hashlib.sha256(data).hexdigest())
+            ).encode()
+        ).hexdigest()
+        entry = os.path.join(self.directory, key + self.suffix)
+        try:
+            with open(entry, "rb") as stream:
+                config = pickle.load(stream)
+            os.utime(entry)
+            return config
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+        config = yaml.load(data, Loader=loader)
+        self._store(entry, config)
+        return config
+
+    def _store(self, entry, config):
+        import pickle
+        import tempfile
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as stream:
+                    pickle.dump(config, stream, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, entry)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            self._evict()
+        except OSError:
+            # the cache is an optimisation, never fail a read because it can't be written
+            pass
+
+    def _evict(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for dirent in it:
+                if dirent.name.endswith(self.suffix):
+                    try:
+                        stat = dirent.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, dirent.path))
+        total = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
 def read_config(file):
     """Read a config file to a dictionary
 
+    Uses the persistent ConfigCache when the SNAKETOOL_CONFIG_CACHE environment variable is set.
+
     Args:
         file (str): Filepath to config YAML file for reading
 
     Returns (dict): Config read from YAML file
     """
+    import yaml
 
+    loader, _ = yaml_backend()
+    cache = ConfigCache.from_env()
+    if cache is not None:
+        return cache.read_config(file, loader)
     with open(file, "r") as stream:
-        config = yaml.safe_load(stream)
+        config = yaml.load(stream, Loader=loader)
     return config
 
 
-def recursive_merge_config(config, overwrite_config):
+class SampleTable:
+    """A TSV/CSV sample table passed to Snakemake by path, so large sample lists stay out of the YAML config
+
+    Use a SampleTable as a config value, e.g. merge_config={"samples": SampleTable("samples.tsv")}, and the config
+    file gets the table's absolute path instead of every sample. run_snakemake validates and indexes the table before
+    the run, and workflows can look up rows with the same class. The first row is the header, and the index column
+    (the first column by default) must have unique, non-empty sample names. The index stores each sample's byte
+    offset for random access, and is cached next to the table (.NAME.index.json) until the table changes.
+
+    Args:
+        path (str): Filepath of the sample table
+        delimiter (str): Column delimiter, defaults to "," for .csv files and tab otherwise
+        index_column (str): Column of sample names, defaults to the first column
+    """
+
+    index_version = 1
+
+    def __init__(self, path, delimiter=None, index_column=None):
+        self.path = os.path.abspath(os.fspath(path))
+        if delimiter is None:
+            delimiter = "," if self.path.lower().endswith(".csv") else "\t"
+        self.delimiter = delimiter
+        self.index_column = index_column
+        self._index = None
+
+    def __fspath__(self):
+        return self.path
+
+    def __repr__(self):
+        return f"SampleTable({self.path!r})"
+
+    def __eq__(self, other):
+        if not isinstance(other, SampleTable):
+            return NotImplemented
+        return (self.path, self.delimiter, self.index_column) == (other.path, other.delimiter, other.index_column)
+
+    def __hash__(self):
+        return hash((self.path, self.delimiter, self.index_column))
+
+    @property
+    def index_path(self):
+        """Filepath of the cached row-offset index"""
+        directory, name = os.path.split(self.path)
+        return os.path.join(directory, f".{name}.index.json")
+
+    def _parse(self, line, line_number):
+        import csv
+
+        try:
+            return next(csv.reader([line.decode("utf-8").rstrip("\r\n")], delimiter=self.delimiter, strict=True), [])
+        except csv.Error as error:
+            raise ValueError(f"{self.path} line {line_number}: {error} (quoted fields can't span lines)") from None
+
+    def index(self):
+        """Validate and index the table, or load the cached index if the table is unchanged
+
+        Returns (dict): Index with the table's columns, index column and sample row offsets
+        """
+        import json
+
+        if self._index is not None:
+            return self._index
+        stat = os.stat(self.path)
+        key = [self.index_version, stat.st_size, stat.st_mtime_ns, self.delimiter, self.index_column]
+        try:
+            with open(self.index_path, "r") as stream:
+                cached = json.load(stream)
+            if cached.get("key") == key:
+                self._index = cached
+                return cached
+        except (OSError, ValueError):
+            pass
+
+        offsets = {}
+        with open(self.path, "rb") as stream:
+            header = stream.readline()
+            columns = self._parse(header, 1)
+            if not columns or not all(columns):
+                raise ValueError(f"{self.path}: the header must name every column")
+            if len(set(columns)) != len(columns):
+                raise ValueError(f"{self.path}: duplicate column names in the header")
+            index_column = self.index_column or columns[0]
+            if index_column not in columns:
+                raise ValueError(f"{self.path}: no {index_column} column")
+            position = columns.index(index_column)
+            offset = len(header)
+            for line_number, line in enumerate(iter(stream.readline, b""), start=2):
+                if line.strip():
+                    fields = self._parse(line, line_number)
+                    if len(fields) != len(columns):
+                        raise ValueError(
+                            f"{self.path} line {line_number}: {len(fields)} columns, expected {len(columns)}"
+                        )
+                    sample = fields[position]
+                    if not sample:
+                        raise ValueError(f"{self.path} line {line_number}: empty {index_column}")
+                    if sample in offsets:
+                        raise ValueError(f"{self.path} line {line_number}: duplicate {index_column} {sample}")
+                    offsets[sample] = offset
+                offset += len(line)
+        self._index = {"key": key, "columns": columns, "index_column": index_column, "offsets": offsets}
+        try:
+            with atomic_write(self.index_path) as stream:
+                json.dump(self._index, stream, separators=(",", ":"))
+        except OSError:
+            # the cached index is only an optimisation, e.g. for tables in read-only directories
+            pass
+        return self._index
+
+    @property
+    def columns(self):
+        """Column names, from the header"""
+        return self.index()["columns"]
+
+    @property
+    def samples(self):
+        """Sample names, in table order"""
+        return list(self.index()["offsets"])
+
+    def __len__(self):
+        return len(self.index()["offsets"])
+
+    def __contains__(self, sample):
+        return sample in self.index()["offsets"]
+
+    def row(self, sample):
+        """Read one sample's row, seeking straight to it with the index
+
+        Args:
+            sample (str): Sample name
+
+        Returns (dict): Row values by column name
+        """
+        index = self.index()
+        offset = index["offsets"][sample]
+        with open(self.path, "rb") as stream:
+            stream.seek(offset)
+            return dict(zip(index["columns"], self._parse(stream.readline(), None)))
+
+    __getitem__ = row
+
+
+def sample_tables(config):
+    """Find the SampleTables in a (nested) config
+
+    Args:
+        config (dict): Dictionary of config values
+
+    Returns (list): SampleTables, in config order
+    """
+    tables = []
+    stack = [iter([config])]
+    while stack:
+        try:
+            value = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+        if isinstance(value, SampleTable):
+            tables.append(value)
+        elif isinstance(value, collections.abc.Mapping):
+            stack.append(iter(value.values()))
+        elif isinstance(value, (list, tuple)):
+            stack.append(iter(value))
+    return tables
+
+
+LIST_STRATEGIES = ("replace", "append", "union")
+
+
+def _merge_list(existing, value, path, list_strategy):
+    """Merge a list value into an existing list following the list strategy for its key path"""
+    if isinstance(list_strategy, str):
+        strategy = list_strategy
+    else:
+        strategy = list_strategy.get(path, list_strategy.get(path[-1], "replace"))
+    if strategy not in LIST_STRATEGIES:
+        raise ValueError(f"Unknown list strategy {strategy}, must be one of {', '.join(LIST_STRATEGIES)}")
+    if strategy == "replace" or not isinstance(existing, (list, tuple)):
+        return value
+    merged = list(existing)
+    if strategy == "append":
+        merged.extend(value)
+        return merged
+    seen = set()
+    for item in merged:
+        try:
+            seen.add(item)
+        except TypeError:
+            pass
+    for item in value:
+        try:
+            if item in seen:
+                continue
+            seen.add(item)
+        except TypeError:
+            if item in merged:
+                continue
+        merged.append(item)
+    return merged
+
+
+def recursive_merge_config(config, overwrite_config, list_strategy=None):
     """Recursively merge a dictionary.
 
-    This is required for updating/merging config dictionaries that are more than one level deep.
+    This is required for updating/merging config dictionaries that are more than one level deep. config is updated in
+    place; the merge is iterative so there is no limit on nesting depth.
 
     Args:
         config (dict): Config dictionary to overwrite (e.g. defaults)
         overwrite_config (dict): Config dictionary of new/updated values to add
+        list_strategy (str | dict): How to merge lists: "replace" (default), "append", or "union" (append new unique
+            items), either for all lists or as a dict of key name or key path tuple to strategy
     """
+    stack = [(config, overwrite_config, ())]
+    while stack:
+        target, updates, path = stack.pop()
+        for key, value in updates.items():
+            if isinstance(value, collections.abc.Mapping):
+                existing = target.get(key)
+                if not isinstance(existing, collections.abc.MutableMapping):
+                    existing = target[key] = {}
+                stack.append((existing, value, path + (key,)))
+            elif list_strategy and isinstance(value, (list, tuple)):
+                target[key] = _merge_list(target.get(key), value, path + (key,), list_strategy)
+            else:
+                target[key] = value
+
+
+def merged_config(config, overwrite_config, list_strategy=None):
+    """Merge two config dictionaries into a new dictionary, leaving both unchanged.
 
-    def _update(d, u):
-        for key, value in u.items():
+    Only the mappings along the paths of overwrite_config are copied; untouched subtrees of config are shared with the
+    new dictionary rather than deep-copied. If config must stay unchanged, only merge into the result with
+    merged_config itself; modifying it in place, including with recursive_merge_config, can change config too.
+
+    Args:
+        config (dict): Config dictionary of original values (e.g. defaults)
+        overwrite_config (dict): Config dictionary of new/updated values to add
+        list_strategy (str | dict): How to merge lists, as for recursive_merge_config
+
+    Returns (dict): New merged config dictionary
+    """
+    merged = dict(config)
+    stack = [(merged, overwrite_config, ())]
+    while stack:
+        target, updates, path = stack.pop()
+        for key, value in updates.items():
             if isinstance(value, collections.abc.Mapping):
-                d[key] = _update(d.get(key, {}), value)
+                existing = target.get(key)
+                target[key] = dict(existing) if isinstance(existing, collections.abc.Mapping) else {}
+                stack.append((target[key], value, path + (key,)))
+            elif list_strategy and isinstance(value, (list, tuple)):
+                target[key] = _merge_list(target.get(key), value, path + (key,), list_strategy)
             else:
-                d[key] = value
-        return d
+                target[key] = value
+    return merged
+
+
+def config_fingerprint(config):
+    """Canonical hash of a config dictionary, independent of key order
+
+    Args:
+        config (dict): Dictionary of config values
+
+    Returns (str): Hex digest of the config
+    """
+    import enum
+    import hashlib
+    import json
+
+    def _default(value):
+        # match how config_dumper writes paths and enums, so the fingerprint is unchanged by a round trip
+        if isinstance(value, os.PathLike):
+            return os.fspath(value)
+        if isinstance(value, enum.Enum):
+            return value.name
+        return repr(value)
+
+    def _sortable(value):
+        if isinstance(value, collections.abc.Mapping):
+            return sorted(([type(k).__name__, repr(k)], _sortable(v)) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return [_sortable(v) for v in value]
+        return value
+
+    try:
+        canonical = json.dumps(config, sort_keys=True, separators=(",", ":"), default=_default)
+    except TypeError:
+        # json can't sort keys of mixed types, so sort on the key type and repr instead
+        canonical = json.dumps(_sortable(config), separators=(",", ":"), default=_default)
+    return hashlib.sha256(canonical.encode()).hexdigest()
 
-    _update(config, overwrite_config)
 
+ConfigUpdate = collections.namedtuple("ConfigUpdate", ["config", "written"])
 
-def update_config(in_config=None, merge=None, output_config=None, log=None):
+
+def update_config(in_config=None, merge=None, output_config=None, log=None, list_strategy=None):
     """Update the default config with the new config values
 
+    The output config file is only rewritten if merging changed its contents, so that its mtime is preserved. The
+    output config is locked while it is read, merged and rewritten, so concurrent updates aren't lost.
+
     Args:
         in_config (str): Filepath to YAML config file
         merge (dict): New values to merge into new config file
         output_config (str): Filepath to write new merged config YAML file
         log (str): Log file for writing STDERR
+        list_strategy (str | dict): How to merge lists, see recursive_merge_config
+
+    Returns (ConfigUpdate): The merged config, and whether output_config was written
     """
     if output_config is None:
         output_config = in_config
-    config = read_config(in_config)
-    msg("Updating config file with new values", log=log)
-    recursive_merge_config(config, merge)
-    write_config(config, output_config, log=log)
+    with config_lock(output_config, log=log):
+        config = read_config(in_config)
+        in_place = os.path.isfile(output_config) and os.path.samefile(in_config, output_config)
+        if in_place:
+            existing = config_fingerprint(config)
+        msg("Updating config file with new values", log=log)
+        recursive_merge_config(config, tuple_to_list(merge), list_strategy=list_strategy)
+        if not in_place:
+            existing = config_fingerprint(read_config(output_config)) if os.path.isfile(output_config) else None
+        if existing == config_fingerprint(config):
+            return ConfigUpdate(config, False)
+        write_config(config, output_config, log=log)
+        return ConfigUpdate(config, True)
 
 
 def tuple_to_list(dictionary):
     """Convert click tuples to lists in (nested) dictionaries for safe dumping with pyyaml
 
+    write_config doesn't need this, as config_dumper writes tuples directly. Tuples nested in lists and tuples are
+    converted too, and the dictionary is walked iteratively so deep nesting doesn't hit the recursion limit.
+
     Args:
         dictionary (dict): dictionary of config for Snakemake
 
@@ -116,28 +1049,287 @@ def tuple_to_list(dictionary):
         dictionary (dict): dictionary with tuples converted to lists
     """
     out_dict = {}
-    for key, value in dictionary.items():
-        if isinstance(value, tuple):
-            out_dict[key] = list(value)
-        elif isinstance(value, dict):
-            out_dict[key] = tuple_to_list(value)
-        else:
-            out_dict[key] = value
+    stack = [(dictionary.items(), out_dict)]
+    while stack:
+        items, target = stack.pop()
+        for key, value in items:
+            if isinstance(value, dict):
+                target[key] = {}
+                stack.append((value.items(), target[key]))
+            elif isinstance(value, (list, tuple)):
+                target[key] = [None] * len(value)
+                stack.append((enumerate(value), target[key]))
+            else:
+                target[key] = value
     return out_dict
 
 
-def write_config(config, file, log=None):
+_MISSING = object()
+
+
+def _summary_scalar(value, max_width=120):
+    """Format a config value on one line for config_summary"""
+    import enum
+    import json
+
+    # show paths, SampleTables and enum members as config_dumper writes them
+    if isinstance(value, os.PathLike):
+        value = os.fspath(value)
+    elif isinstance(value, enum.Enum):
+        value = value.name
+    if value is None:
+        text = "null"
+    elif isinstance(value, bool):
+        text = "true" if value else "false"
+    elif isinstance(value, (int, float)):
+        text = str(value)
+    elif isinstance(value, str):
+        text = value if value and value.strip() == value and ": " not in value else json.dumps(value)
+    else:
+        text = json.dumps(value, default=str)
+    if len(text) > max_width:
+        text = text[: max_width - 3] + "..."
+    return text
+
+
+def _summary_lines(config, defaults, max_items):
+    """Generate YAML-like lines of config values that differ from defaults, in one pass over config
+
+    Mapping keys are only written once a value below them differs from the defaults, and mappings and lists are cut
+    short after max_items entries, with a count of what was left out. A config that isn't a mapping (e.g. None from an
+    empty config file) is written as a single value or list.
+    """
+    if not isinstance(config, collections.abc.Mapping):
+        if isinstance(config, (list, tuple)) and config:
+            yield from _summary_list(config, "", max_items)
+        else:
+            yield _summary_scalar(config)
+        return
+    # each frame is [indent, items iterator, defaults, header line, header written, items written, items skipped]
+    frames = [[0, iter(config.items()), defaults, None, True, 0, 0]]
+    while frames:
+        frame = frames[-1]
+        indent, items, frame_defaults = " " * frame[0], frame[1], frame[2]
+        try:
+            key, value = next(items)
+        except StopIteration:
+            frames.pop()
+            if frame[6]:
+                yield f"{indent}... ({frame[6]} more keys)"
+            continue
+        default = _MISSING
+        if isinstance(frame_defaults, collections.abc.Mapping):
+            default = frame_defaults.get(key, _MISSING)
+        if isinstance(value, collections.abc.Mapping) and value:
+            if frame[5] >= max_items:
+                frame[6] += value != default
+                continue
+            sub_defaults = default if isinstance(default, collections.abc.Mapping) else None
+            frames.append([frame[0] + 2, iter(value.items()), sub_defaults, f"{indent}{key}:", False, 0, 0])
+            continue
+        if value == default:
+            continue
+        if frame[5] >= max_items:
+            frame[6] += 1
+            continue
+        # write the headers of the mappings this value is in
+        for parent, child in zip(frames, frames[1:]):
+            if not child[4]:
+                yield child[3]
+                child[4] = True
+                parent[5] += 1
+        frame[5] += 1
+        if isinstance(value, (list, tuple)) and value:
+            yield f"{indent}{key}:"
+            yield from _summary_list(value, indent, max_items)
+        else:
+            yield f"{indent}{key}: {_summary_scalar(value)}"
+
+
+def _summary_list(value, indent, max_items):
+    """Generate the YAML-like lines of a list for config_summary, cut short after max_items items"""
+    for item in value[:max_items]:
+        yield f"{indent}- {_summary_scalar(item)}"
+    if len(value) > max_items:
+        yield f"{indent}- ... ({len(value) - max_items} more items)"
+
+
+def config_summary(config, defaults=None, max_items=10, max_chars=10000):
+    """Summarise a config for display, optionally only showing values that differ from defaults
+
+    Long lists and mappings are cut short with a count of the entries left out, and the summary is cut off after
+    max_chars characters, so display time and size don't grow with the size of the config.
+
+    Args:
+        config (dict): Dictionary of config values (or None for an empty config file)
+        defaults (dict): Dictionary of default config values, values equal to these are left out
+        max_items (int): Maximum entries of each list or mapping to show
+        max_chars (int): Maximum length of the summary
+
+    Returns (str): YAML-like summary of the config
+    """
+    if defaults is not None and config == defaults:
+        return "(no changes from the default config)"
+    lines = []
+    length = 0
+    for line in _summary_lines(config, defaults, max_items):
+        length += len(line) + 1
+        if length > max_chars:
+            lines.append(f"... (cut off after {max_chars} characters)")
+            break
+        lines.append(line)
+    if not lines and defaults is not None:
+        return "(no changes from the default config)"
+    return "\n".join(lines)
+
+
+@contextmanager
+def atomic_write(file, mode="w", exclusive=False):
+    """Open a temporary file for writing that replaces file when closed
+
+    The temporary file is fsynced and renamed over file, so readers only ever see the old or the new complete file.
+    The temporary file is removed instead if an exception is raised.
+
+    Args:
+        file (str): Filepath to write
+        mode (str): File mode, "w" or "wb"
+        exclusive (bool): Raise FileExistsError instead of replacing file if it already exists when publishing
+    """
+    import errno
+    import secrets
+    from shutil import copymode
+
+    file = os.fspath(file)
+    # created with the permissions open() would give a new file (0o666 less the umask), unlike tempfile.mkstemp, so
+    # new files need no chmod, and the umask is never changed to read it while other threads may be creating files
+    while True:
+        tmp = os.path.join(os.path.dirname(os.path.abspath(file)), f".{secrets.token_hex(8)}.tmp")
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_CLOEXEC", 0), 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        with os.fdopen(fd, mode) as stream:
+            yield stream
+            stream.flush()
+            os.fsync(stream.fileno())
+        if os.path.exists(file):
+            copymode(file, tmp)
+        if not exclusive:
+            os.replace(tmp, file)
+            return
+        # hard linking publishes the file without clobbering one that another process has just written
+        try:
+            os.link(tmp, file)
+        except OSError as error:
+            if error.errno not in (errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EXDEV, errno.ENOSYS):
+                raise
+            # the filesystem doesn't support hard links, fall back to checking then renaming
+            if os.path.exists(file):
+                raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), file) from None
+            os.replace(tmp, file)
+        else:
+            os.unlink(tmp)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+_held_locks = threading.local()
+
+
+def lock_path(file):
+    """Filepath of the advisory lock file used by config_lock for file
+
+    Args:
+        file (str): Filepath being locked
+
+    Returns (str): Filepath of the hidden lock file next to file
+    """
+    directory, name = os.path.split(os.path.abspath(os.fspath(file)))
+    return os.path.join(directory, f".{name}.lock")
+
+
+@contextmanager
+def config_lock(file, timeout=None, log=None):
+    """Hold an exclusive advisory lock on a file while it is read, checked or rewritten
+
+    Processes launched together in the same directory (e.g. array jobs) take turns: the lock is a flock on a hidden
+    lock file next to file, which is left in place as deleting it could let two processes hold different locks. Locks
+    are re-entrant within a thread, and nothing is locked on platforms without fcntl.
+
+    Args:
+        file (str): Filepath to lock
+        timeout (float): Seconds to wait for the lock before raising TimeoutError, defaults to the
+            SNAKETOOL_LOCK_TIMEOUT environment variable, or 60
+        log (str): Filepath of log file for writing STDERR
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+
+    path = lock_path(file)
+    held = _held_locks.__dict__.setdefault("counts", {})
+    if held.get(path):
+        held[path] += 1
+        try:
+            yield
+        finally:
+            held[path] -= 1
+        return
+
+    if timeout is None:
+        timeout = float(os.environ.get("SNAKETOOL_LOCK_TIMEOUT", 60))
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        deadline = monotonic() + timeout
+        delay = 0.001
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if monotonic() >= deadline:
+                    raise TimeoutError(f"Timed out after {timeout}s waiting for the lock on {file}") from None
+                if not waiting:
+                    msg(f"Waiting for another process to release {file}", log=log)
+                    waiting = True
+                # back off to avoid hammering shared filesystems, but keep the wait short for quick config updates
+                time_left = deadline - monotonic()
+                threading.Event().wait(max(min(delay, time_left), 0))
+                delay = min(delay * 2, 0.1)
+        held[path] = 1
+        try:
+            yield
+        finally:
+            held[path] = 0
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def write_config(config, file, log=None, exclusive=False):
     """Write the config dictionary to a YAML file
 
+    The file is replaced atomically, so a crash mid-write won't leave a partial config file. Click's tuples and paths
+    are written as they are serialised by config_dumper, without copying the config.
+
     Args:
         config (dict): Dictionary of config values
         file (str): Filepath of config file for writing
         log (str): Filepath of log file for writing STDERR
+        exclusive (bool): Raise FileExistsError instead of replacing file if it already exists
     """
+    import yaml
+
     msg(f"Writing config file to {file}", log=log)
-    config = tuple_to_list(config)
-    with open(file, "w") as stream:
-        yaml.dump(config, stream)
+    with atomic_write(file, exclusive=exclusive) as stream:
+        yaml.dump(config, stream, Dumper=config_dumper())
 
 
 def copy_config(
@@ -148,31 +1340,54 @@ def copy_config(
 ):
     """Copy a config file, optionally merging in new config values.
 
+    Safe for processes launched together: local_config is locked while it is checked and created, and it is only
+    published once complete and if no other process has created it first.
+
     Args:
         local_config (str): Filepath of new config YAML for writing
         merge_config (dict): Config values for merging
         system_config (str): Filepath of original config YAML file for reading
         log (str): Filepath of log file for writing STDERR
+
+    Returns (dict): The merged config if merge_config was merged into a new local_config, otherwise None
     """
-    if not os.path.isfile(local_config):
-        if len(os.path.dirname(local_config)) > 0:
-            os.makedirs(os.path.dirname(local_config), exist_ok=True)
-        msg(f"Copying system default config to {local_config}", log=log)
+    return _copy_config(local_config, merge_config, system_config, log)[0]
 
-        if merge_config:
-            update_config(
-                in_config=system_config,
-                merge=merge_config,
-                output_config=local_config,
-                log=log,
-            )
-        else:
-            copyfile(system_config, local_config)
-    else:
+
+def _copy_config(local_config, merge_config, system_config, log):
+    """copy_config, also returning the parsed system config if it was read to merge into, otherwise None
+
+    The parsed system config shares the subtrees merge_config didn't change with the merged config, so neither may
+    be modified in place while the other is in use.
+
+    Returns (tuple): The merged config or None, and the parsed system config or None
+    """
+    from shutil import copyfileobj
+
+    if len(os.path.dirname(local_config)) > 0:
+        os.makedirs(os.path.dirname(local_config), exist_ok=True)
+    with config_lock(local_config, log=log):
+        if not os.path.isfile(local_config):
+            msg(f"Copying system default config to {local_config}", log=log, event="config_copy", config=local_config)
+            try:
+                if merge_config:
+                    defaults = read_config(system_config)
+                    msg("Updating config file with new values", log=log)
+                    # copy-on-write, so the parsed system config stays unchanged for build_snakemake_command's summary
+                    config = merged_config(defaults or {}, tuple_to_list(merge_config))
+                    write_config(config, local_config, log=log, exclusive=True)
+                    return config, defaults
+                with open(system_config, "rb") as src, atomic_write(local_config, "wb", exclusive=True) as dst:
+                    copyfileobj(src, dst)
+                return None, None
+            except FileExistsError:
+                # created by a process that doesn't hold the lock, e.g. on a filesystem without flock support
+                pass
         msg(
             f"Config file {local_config} already exists. Using existing config file.",
             log=log,
         )
+    return None, None
 
 
 def initialise_config(
@@ -198,12 +1413,754 @@ def initialise_config(
         copy_config(workflow_profile_yaml, system_config=system_workflow_profile, log=log)
 
 
-def run_snakemake(
+class _OutputCopy:
+    """Copy a command's output to STDOUT/STDERR, the log and a ProgressMonitor, without ever raising
+
+    Copying to each of them stops at its first error, which is kept in errors and reported by report() once the
+    command has finished, so the output is still read (and the command never blocks on a full pipe) and still copied
+    to the others, e.g. to the log after the terminal has gone away.
+    """
+
+    def __init__(self, log=None, monitor=None):
+        self.log = log
+        self.monitor = monitor
+        self.errors = {}
+
+    def write(self, text, err):
+        """Copy some of the command's output from STDERR (err=True) or STDOUT"""
+        if not text:
+            return
+        stream = "stderr" if err else "stdout"
+        self._copy("terminal", click.echo, text, nl=False, err=err)
+        if self.log:
+            if _structured(self.log):
+                self._copy("log", log_event, text.rstrip("\n"), log=self.log, event="output", stream=stream)
+            else:
+                self._copy("log", self.log.write, text)
+        if self.monitor is not None:
+            self._copy("progress monitor", self.monitor.feed, text, stream=stream)
+
+    def _copy(self, target, func, *args, **kwargs):
+        if target in self.errors:
+            return
+        try:
+            func(*args, **kwargs)
+        except Exception as error:
+            # called from the reader of each stream, so only keep the first error
+            self.errors.setdefault(target, error)
+
+    def report(self):
+        """Report the first error copying to each target, to the terminal and log if they still work"""
+        log = None if "log" in self.errors else self.log
+        for target, error in self.errors.items():
+            message = f"WARNING: Stopped copying the command's output to the {target}: {error}"
+            if "terminal" not in self.errors:
+                msg(message, log=log, level="WARNING")
+            elif log and _structured(log):
+                log_event(message, log=log, level="WARNING")
+            elif log:
+                _write_log(_timestamps(time())[0] + message + "\n", log)
+
+
+class ProgressMonitor:
+    """Track a Snakemake run's progress from its output, and export throughput and ETA while it runs
+
+    Snakemake's output is parsed in the process copying it to the terminal, so the run itself isn't slowed down.
+    Progress lines ("N of M steps (X%) done"), job starts ("rule NAME:"), finished jobs ("Finished job N.") and errors
+    ("Error in rule NAME:") are counted, and throughput is the rate of finished jobs over the last window seconds. The
+    metrics are written atomically to a Prometheus textfile-collector file and/or a JSON status file at most once
+    every interval seconds as output arrives, and when the monitor is closed. With sharded runs, done and total are
+    from the latest progress line of any batch. Failing to write the metrics never interrupts the run: the first
+    error is kept in write_error and reported when the monitor is closed.
+
+    Args:
+        prometheus_file (str): Filepath of Prometheus textfile-collector file (.prom) to write
+        status_file (str): Filepath of JSON status file to write
+        interval (float): Minimum seconds between writes
+        window (float): Seconds of finished jobs to calculate throughput over
+    """
+
+    _pattern = None
+
+    def __init__(self, prometheus_file=None, status_file=None, interval=15.0, window=3600.0):
+        self.prometheus_file = prometheus_file
+        self.status_file = status_file
+        self.interval = interval
+        self.window = window
+        self.done = 0
+        self.total = None
+        self.started = 0
+        self.finished = 0
+        self.errors = 0
+        self.running = True
+        self.start_time = monotonic()
+        self.last_progress = None
+        self._finish_times = collections.deque()
+        self._partial = {}
+        self._last_write = None
+        self._lock = threading.Lock()
+        self.write_error = None
+
+    @classmethod
+    def _regex(cls):
+        if cls._pattern is None:
+            import re
+
+            cls._pattern = re.compile(
+                r"(?P<done>\d+) of (?P<total>\d+) steps \([\d.]+%\) done"
+                r"|^(?:local)?(?:rule|checkpoint) \S+:\s*$"
+                r"|(?P<finished>^Finished job(?:id:)? \d+)"
+                r"|(?P<error>^Error in rule )"
+            )
+        return cls._pattern
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def feed(self, text, stream="stderr", now=None):
+        """Parse a chunk of output, writing the metrics if they are due
+
+        Args:
+            text (str): Output from Snakemake, partial lines are joined with the next chunk from the same stream
+            stream (str): Name of the stream the output is from
+            now (float): monotonic() time the output arrived, defaults to now
+        """
+        now = monotonic() if now is None else now
+        regex = self._regex()
+        with self._lock:
+            lines = (self._partial.pop(stream, "") + text).split("\n")
+            if lines[-1]:
+                self._partial[stream] = lines[-1]
+            for line in lines[:-1]:
+                match = regex.search(line)
+                if match is None:
+                    continue
+                if match["done"] is not None:
+                    self.done, self.total = int(match["done"]), int(match["total"])
+                    self.last_progress = time()
+                elif match["finished"] is not None:
+                    self.finished += 1
+                    self._finish_times.append(now)
+                elif match["error"] is not None:
+                    self.errors += 1
+                else:
+                    self.started += 1
+            if self._last_write is None or now - self._last_write >= self.interval:
+                self._write(now)
+
+    def jobs_per_hour(self, now=None):
+        """Rate of finished jobs over the last window seconds
+
+        Args:
+            now (float): monotonic() time to calculate the rate at, defaults to now
+
+        Returns (float): Finished jobs per hour
+        """
+        now = monotonic() if now is None else now
+        while self._finish_times and self._finish_times[0] < now - self.window:
+            self._finish_times.popleft()
+        elapsed = min(self.window, now - self.start_time)
+        if not self._finish_times or elapsed <= 0:
+            return 0.0
+        return len(self._finish_times) * 3600 / elapsed
+
+    def status(self, now=None):
+        """Current progress, throughput and ETA of the run
+
+        Args:
+            now (float): monotonic() time to report the status at, defaults to now
+
+        Returns (dict): Progress metrics, with eta_seconds None while no jobs have finished or the total is unknown
+        """
+        now = monotonic() if now is None else now
+        rate = self.jobs_per_hour(now)
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = (self.total - self.done) * 3600 / rate
+        return {
+            "run_id": run_id(),
+            "running": self.running,
+            "done": self.done,
+            "total": self.total,
+            "percent": 100 * self.done / self.total if self.total else None,
+            "jobs_started": self.started,
+            "jobs_finished": self.finished,
+            "errors": self.errors,
+            "jobs_per_hour": rate,
+            "eta_seconds": eta,
+            "elapsed_seconds": now - self.start_time,
+            "last_progress": _timestamps(self.last_progress)[1] if self.last_progress else None,
+            "updated": _timestamps(time())[1],
+        }
+
+    def _write(self, now):
+        self._last_write = now
+        try:
+            self._write_files(self.status(now))
+        except OSError as error:
+            # called while copying Snakemake's output, so don't raise or print here; close() reports it once
+            if self.write_error is None:
+                self.write_error = error
+
+    def _write_files(self, status):
+        import json
+
+        if self.status_file:
+            with atomic_write(self.status_file) as stream:
+                json.dump(status, stream, indent=2)
+        if self.prometheus_file:
+            labels = f'{{run_id="{status["run_id"]}"}}'
+            metrics = [
+                ("running", "gauge", "Whether Snakemake is running", int(self.running)),
+                ("jobs_done", "gauge", "Steps done, from Snakemake's progress", self.done),
+                ("jobs_total", "gauge", "Total steps, from Snakemake's progress", self.total),
+                ("jobs_started_total", "counter", "Jobs started", self.started),
+                ("jobs_finished_total", "counter", "Jobs finished", self.finished),
+                ("job_errors_total", "counter", "Jobs that failed", self.errors),
+                ("jobs_per_hour", "gauge", "Rate of finished jobs", status["jobs_per_hour"]),
+                ("eta_seconds", "gauge", "Estimated seconds until all steps are done", status["eta_seconds"]),
+                ("last_progress_timestamp_seconds", "gauge", "Time of the last progress line", self.last_progress),
+            ]
+            with atomic_write(self.prometheus_file) as stream:
+                for name, kind, description, value in metrics:
+                    stream.write(f"# HELP snaketool_{name} {description}\n# TYPE snaketool_{name} {kind}\n")
+                    stream.write(f"snaketool_{name}{labels} {'NaN' if value is None else value}\n")
+
+    def write(self):
+        """Write the metrics now"""
+        with self._lock:
+            self._write(monotonic())
+
+    def close(self, log=None):
+        """Mark the run as finished, write the final metrics, and report the first error writing them, if any
+
+        Args:
+            log (str | LogSink): Filepath to log file, or LogSink, for the error message
+        """
+        with self._lock:
+            partials = list(self._partial.items())
+            self._partial.clear()
+        for stream, partial in partials:
+            self.feed(partial + "\n", stream=stream)
+        with self._lock:
+            self.running = False
+            self._write(monotonic())
+        if self.write_error is not None:
+            msg(f"WARNING: Couldn't write progress metrics: {self.write_error}", log=log)
+
+
+def _tee_stream(pipe, err, output, chunk_size):
+    """Copy a subprocess pipe to an _OutputCopy, a line (or chunk_size bytes) at a time"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    try:
+        for chunk in iter(lambda: pipe.readline(chunk_size), b""):
+            output.write(decoder.decode(chunk), err)
+        output.write(decoder.decode(b"", final=True), err)
+    finally:
+        pipe.close()
+
+
+def run_command(command, log=None, chunk_size=65536, monitor=None, usage=None):
+    """Run a command without a shell, copying its STDOUT and STDERR to the log file
+
+    Without a log or monitor the command simply inherits STDOUT and STDERR. Otherwise, its output is read line by line
+    (lines longer than chunk_size are split) on one thread per stream and written to the terminal, the log and the
+    monitor as it arrives, so memory use is bounded and the command never blocks on a full pipe. A log filepath is
+    written through a LogSink, so output reaches the log within a second even while the command is quiet. If copying
+    to the terminal, log or monitor fails, the output is still copied to the others, and the error is reported once
+    the command has finished.
+
+    Args:
+        command (list): Command and arguments to run
+        log (str | LogSink): Filepath to log file, or LogSink, for writing
+        chunk_size (int): Maximum bytes to read from the command's output at a time
+        monitor (ProgressMonitor): Monitor to pass the command's output to
+        usage (dict): Dictionary to add the command's user_time, system_time and max_rss_bytes to (see _usage_dict),
+            only measured when the output is copied to a log or monitor
+
+    Returns (int): Exit code of the command
+    """
+    import subprocess
+
+    command = [str(s) for s in command]
+    try:
+        if not log and monitor is None:
+            return subprocess.run(command).returncode
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        msg(f"ERROR: command not found: {command[0]}", log=log)
+        return 127
+    if not log:
+        sink = None
+    else:
+        sink = log if isinstance(log, LogSink) else LogSink(log)
+    output = _OutputCopy(sink, monitor)
+    readers = [
+        threading.Thread(target=_tee_stream, args=(process.stdout, False, output, chunk_size), daemon=True),
+        threading.Thread(target=_tee_stream, args=(process.stderr, True, output, chunk_size), daemon=True),
+    ]
+    try:
+        for reader in readers:
+            reader.start()
+        returncode = _wait_process(process, usage)
+        for reader in readers:
+            reader.join()
+        output.report()
+    finally:
+        if isinstance(log, LogSink):
+            sink.flush()
+        elif sink is not None:
+            sink.close()
+    return returncode
+
+
+def run_sharded(snake_command, batch_rule, batches, concurrency=1, log=None, monitor=None, usage=None):
+    """Split a Snakemake run into batches of a rule's input files with --batch RULE=i/N, and run them
+
+    Batches 1 to N-1 are run with up to concurrency at a time, then batch N, which also runs the aggregating rule
+    itself, is run once they have all succeeded. The --cores of snake_command are divided between the batches running
+    at once (at least one core each), and batch N gets them all; a command without a numeric --cores (e.g. using a
+    profile) is passed to every batch unchanged. With a log, each batch's output is written to its own log next to it,
+    and the batch logs are then moved into the log in order.
+
+    Concurrent batches run in the same working directory, so each takes Snakemake's locks on its inputs and outputs.
+    Batches of one rule's inputs have separate outputs, but a job needed by several batches (e.g. indexing a shared
+    reference) can make a batch fail with "Directory cannot be locked"; run such jobs first, or with concurrency=1.
+    Don't add --nolock to get around this, as concurrent batches could then write the same files at once.
+
+    Args:
+        snake_command (list): Snakemake command and arguments
+        batch_rule (str): Name of the aggregating rule to batch the input files of
+        batches (int): Number of batches
+        concurrency (int): Maximum number of batches to run at once
+        log (str | LogSink): Filepath to log file, or LogSink, for writing
+        monitor (ProgressMonitor): Monitor to pass the batches' output to
+        usage (dict): Dictionary to add the batches' total user_time and system_time, and largest max_rss_bytes to
+
+    Returns (int): 0 if all batches succeeded, otherwise the exit code of the first failed batch
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from shutil import copyfileobj
+
+    def _batch_log(batch):
+        if not log:
+            return None
+        return f"{os.path.splitext(os.fspath(log))[0]}.batch{batch}of{batches}.log"
+
+    # share the cores between the batches that run at once
+    cores_index = snake_command.index("--cores") + 1 if "--cores" in snake_command else None
+    concurrent = max(1, min(concurrency, batches - 1))
+    cores = None
+    if cores_index is not None and cores_index < len(snake_command) and str(snake_command[cores_index]).isdigit():
+        cores = int(snake_command[cores_index])
+
+    def _run_batch(batch):
+        batch_log = _batch_log(batch)
+        if batch_log and os.path.exists(batch_log):
+            os.remove(batch_log)
+        command = list(snake_command) + ["--batch", f"{batch_rule}={batch}/{batches}"]
+        if cores is not None and batch < batches:
+            command[cores_index] = str(max(1, cores // concurrent))
+        cores_msg = f" with {command[cores_index]} cores" if cores is not None else ""
+        msg(f"Running batch {batch} of {batches} for rule {batch_rule}{cores_msg}", log=log)
+        if batch_log and _structured(log):
+            with LogSink(batch_log, structured=True) as sink:
+                return run_command(command, log=sink, monitor=monitor, usage=usage)
+        return run_command(command, log=batch_log, monitor=monitor, usage=usage)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        returncodes = list(pool.map(_run_batch, range(1, batches)))
+    if all(returncode == 0 for returncode in returncodes):
+        returncodes.append(_run_batch(batches))
+    else:
+        msg(f"ERROR: Not running the final batch of rule {batch_rule} as earlier batches failed", log=log)
+
+    # aggregate the batch logs into the log
+    for batch, returncode in enumerate(returncodes, start=1):
+        batch_log = _batch_log(batch)
+        if batch_log and os.path.exists(batch_log):
+            header = f"==> batch {batch} of {batches} for rule {batch_rule} (exit code {returncode}) <==\n"
+            with open(batch_log, "r") as stream:
+                if _structured(log):
+                    # the batch log is already JSON lines, so only the header needs converting
+                    log_event(
+                        header.strip(),
+                        log=log,
+                        event="batch_log",
+                        batch=batch,
+                        batches=batches,
+                        rule=batch_rule,
+                        returncode=returncode,
+                    )
+                    for line in stream:
+                        _write_log(line, log)
+                elif isinstance(log, LogSink):
+                    log.write(header)
+                    for line in stream:
+                        log.write(line)
+                else:
+                    with open(log, "a") as out:
+                        out.write(header)
+                        copyfileobj(stream, out)
+            os.remove(batch_log)
+    return next((returncode for returncode in returncodes if returncode != 0), 0)
+
+
+def _cgroup_dirs(controller, cgroup_root="/sys/fs/cgroup", proc_cgroup="/proc/self/cgroup"):
+    """Find this process's cgroup directory and its ancestors for a cgroup v1 controller, or cgroup v2 if None
+
+    Returns (list): Existing cgroup directories, from this process's cgroup up to the root of the hierarchy
+    """
+    try:
+        with open(proc_cgroup, "r") as stream:
+            lines = stream.read().splitlines()
+    except OSError:
+        return []
+    for line in lines:
+        hierarchy, controllers, path = line.split(":", 2)
+        if controller is None and hierarchy == "0" and controllers == "":
+            mount = cgroup_root
+        elif controller is not None and controller in controllers.split(","):
+            mount = os.path.join(cgroup_root, controllers)
+            if not os.path.isdir(mount):
+                mount = os.path.join(cgroup_root, controller)
+        else:
+            continue
+        dirs = []
+        path = path.strip("/")
+        while True:
+            directory = os.path.join(mount, path)
+            if os.path.isdir(directory):
+                dirs.append(directory)
+            if not path:
+                return dirs
+            path = os.path.dirname(path)
+    return []
+
+
+def _read_cgroup_value(directory, filename):
+    try:
+        with open(os.path.join(directory, filename), "r") as stream:
+            return stream.read().split()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit(cgroup_root="/sys/fs/cgroup", proc_cgroup="/proc/self/cgroup"):
+    """Get the CPU quota of this process's cgroup (v2 cpu.max or v1 cpu.cfs_quota_us), including its ancestors
+
+    Args:
+        cgroup_root (str): Mount point of the cgroup filesystem
+        proc_cgroup (str): Filepath of this process's cgroup membership
+
+    Returns (float): Number of CPUs allowed by the quota, or None if there is no quota
+    """
+    limits = []
+    for directory in _cgroup_dirs(None, cgroup_root, proc_cgroup):
+        value = _read_cgroup_value(directory, "cpu.max")
+        if value and value[0] != "max":
+            limits.append(int(value[0]) / int(value[1]))
+    for directory in _cgroup_dirs("cpu", cgroup_root, proc_cgroup):
+        quota = _read_cgroup_value(directory, "cpu.cfs_quota_us")
+        period = _read_cgroup_value(directory, "cpu.cfs_period_us")
+        if quota and period and int(quota[0]) > 0:
+            limits.append(int(quota[0]) / int(period[0]))
+    return min(limits) if limits else None
+
+
+def cgroup_memory_limit(cgroup_root="/sys/fs/cgroup", proc_cgroup="/proc/self/cgroup"):
+    """Get the memory limit of this process's cgroup (v2 memory.max or v1 memory.limit_in_bytes), including ancestors
+
+    Args:
+        cgroup_root (str): Mount point of the cgroup filesystem
+        proc_cgroup (str): Filepath of this process's cgroup membership
+
+    Returns (int): Memory limit in bytes, or None if there is no limit
+    """
+    limits = []
+    for directory in _cgroup_dirs(None, cgroup_root, proc_cgroup):
+        value = _read_cgroup_value(directory, "memory.max")
+        if value and value[0] != "max":
+            limits.append(int(value[0]))
+    for directory in _cgroup_dirs("memory", cgroup_root, proc_cgroup):
+        value = _read_cgroup_value(directory, "memory.limit_in_bytes")
+        # v1 reports "no limit" as a huge page-aligned number
+        if value and int(value[0]) < 2**60:
+            limits.append(int(value[0]))
+    return min(limits) if limits else None
+
+
+def available_cores(cgroup_root="/sys/fs/cgroup", proc_cgroup="/proc/self/cgroup"):
+    """Number of CPUs this process may use: its CPU affinity, capped by any cgroup CPU quota (rounded down)
+
+    Args:
+        cgroup_root (str): Mount point of the cgroup filesystem
+        proc_cgroup (str): Filepath of this process's cgroup membership
+
+    Returns (int): Usable CPUs, at least 1
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    quota = cgroup_cpu_limit(cgroup_root, proc_cgroup)
+    if quota is not None:
+        cores = min(cores, int(quota))
+    return max(1, cores)
+
+
+def available_memory_mb(cgroup_root="/sys/fs/cgroup", proc_cgroup="/proc/self/cgroup"):
+    """Memory this process may use according to its cgroup memory limit, in MB
+
+    Args:
+        cgroup_root (str): Mount point of the cgroup filesystem
+        proc_cgroup (str): Filepath of this process's cgroup membership
+
+    Returns (int): Memory limit in MB, or None if there is no limit
+    """
+    limit = cgroup_memory_limit(cgroup_root, proc_cgroup)
+    if limit is None:
+        return None
+    return limit // 2**20
+
+
+@contextmanager
+def _timed_phase(phase_times, phase):
+    """Add the time spent in the with block to phase_times[phase]"""
+    start = monotonic()
+    try:
+        yield
+    finally:
+        if phase_times is not None:
+            phase_times[phase] = phase_times.get(phase, 0.0) + monotonic() - start
+
+
+def _usage_dict(usage):
+    """Convert a struct_rusage to a dictionary of user_time and system_time in seconds, and max_rss_bytes"""
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    rss_scale = 1 if sys.platform == "darwin" else 1024
+    return {
+        "user_time": usage.ru_utime,
+        "system_time": usage.ru_stime,
+        "max_rss_bytes": usage.ru_maxrss * rss_scale,
+    }
+
+
+def _wait_process(process, usage=None):
+    """Wait for a Popen process, adding its resource usage (and its waited-for descendants') to usage if given"""
+    if usage is None or not hasattr(os, "wait4"):
+        return process.wait()
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    for key, value in _usage_dict(rusage).items():
+        if key == "max_rss_bytes":
+            usage[key] = max(usage.get(key, 0), value)
+        else:
+            usage[key] = usage.get(key, 0.0) + value
+    return process.returncode
+
+
+def run_report_path(log):
+    """Filepath of the JSON run report written next to a log file
+
+    Args:
+        log (str | LogSink): Filepath to log file, or LogSink
+
+    Returns (str): Filepath of the run report
+    """
+    return os.path.splitext(os.fspath(log))[0] + ".report.json"
+
+
+def write_run_report(report, file):
+    """Write a run report dictionary to a JSON file
+
+    Args:
+        report (dict): Run report
+        file (str): Filepath of JSON file for writing
+    """
+    import json
+
+    with atomic_write(file) as stream:
+        json.dump(report, stream, indent=2)
+        stream.write("\n")
+
+
+def workflow_files(snakefile_path):
+    """Find a Snakefile and the files it includes (recursively) with include: statements
+
+    Args:
+        snakefile_path (str): Filepath of Snakefile
+
+    Returns (list): Filepaths of the Snakefile and its includes
+    """
+    import re
+
+    include = re.compile(r"^\s*include:\s*[\"'](.+?)[\"']", re.MULTILINE)
+    files = []
+    queue = [os.path.normpath(snakefile_path)]
+    while queue:
+        path = queue.pop(0)
+        if path in files:
+            continue
+        files.append(path)
+        try:
+            with open(path, "r") as stream:
+                text = stream.read()
+        except OSError:
+            continue
+        for included in include.findall(text):
+            queue.append(os.path.normpath(os.path.join(os.path.dirname(path), included)))
+    return files
+
+
+def conda_env_files(snakefile_path):
+    """Find the conda environment files used by a workflow's conda: directives
+
+    Only conda: directives with a literal filepath can be found. If there are none, any .yaml/.yml files in an envs/
+    directory next to the Snakefile are used instead.
+
+    Args:
+        snakefile_path (str): Filepath of Snakefile, its includes are also searched
+
+    Returns (list): Filepaths of conda environment files
+    """
+    import re
+
+    directive = re.compile(r"^\s*conda:\s*[\"'](.+?\.ya?ml)[\"']", re.MULTILINE)
+    env_files = []
+    for path in workflow_files(snakefile_path):
+        try:
+            with open(path, "r") as stream:
+                text = stream.read()
+        except OSError:
+            continue
+        for env_file in directive.findall(text):
+            env_file = os.path.normpath(os.path.join(os.path.dirname(path), env_file))
+            if env_file not in env_files:
+                env_files.append(env_file)
+    if not env_files:
+        envs_dir = os.path.join(os.path.dirname(snakefile_path), "envs")
+        if os.path.isdir(envs_dir):
+            env_files = sorted(
+                os.path.join(envs_dir, name) for name in os.listdir(envs_dir) if name.endswith((".yaml", ".yml"))
+            )
+    return env_files
+
+
+def prewarm_conda_envs(snake_command, snakefile_path, conda_prefix, log=None):
+    """Create a workflow's conda environments with --conda-create-envs-only, unless they were already created
+
+    The hashes of the environment files that have been created are kept in a manifest in conda_prefix, and Snakemake
+    is only run if an environment file isn't in the manifest (or no environment files can be found).
+
+    Args:
+        snake_command (list): Snakemake command and arguments for the main run
+        snakefile_path (str): Filepath of Snakefile
+        conda_prefix (str): Filepath of Snakemake's --conda-prefix
+        log (str | LogSink): Filepath to log file, or LogSink, for writing
+
+    Returns (int): Exit code of creating the environments, 0 if they were already created
+    """
+    import hashlib
+    import json
+
+    manifest_file = os.path.join(conda_prefix, ".snaketool_envs.json")
+    env_hashes = {}
+    for env_file in conda_env_files(snakefile_path):
+        try:
+            with open(env_file, "rb") as stream:
+                env_hashes[env_file] = hashlib.sha256(stream.read()).hexdigest()
+        except OSError:
+            env_hashes[env_file] = None
+    try:
+        with open(manifest_file, "r") as stream:
+            manifest = set(json.load(stream))
+    except (OSError, ValueError):
+        manifest = set()
+    if env_hashes and None not in env_hashes.values() and manifest.issuperset(env_hashes.values()):
+        msg(f"All {len(env_hashes)} conda environments already exist in {conda_prefix}", log=log)
+        return 0
+
+    msg(f"Creating conda environments in {conda_prefix}", log=log)
+    returncode = run_command(list(snake_command) + ["--conda-create-envs-only"], log=log)
+    if returncode == 0 and env_hashes:
+        os.makedirs(conda_prefix, exist_ok=True)
+        manifest.update(env_hash for env_hash in env_hashes.values() if env_hash)
+        with atomic_write(manifest_file) as stream:
+            json.dump(sorted(manifest), stream, indent=2)
+    return returncode
+
+
+def _profile_config(profile):
+    """Filepath of a Snakemake profile's config.yaml, given as a directory or the name of an installed profile"""
+    if profile is None:
+        return None
+    candidates = [profile] + [
+        os.path.join(directory, profile)
+        for directory in (os.path.expanduser("~/.config/snakemake"), "/etc/xdg/snakemake")
+    ]
+    for candidate in candidates:
+        if os.path.isfile(os.path.join(candidate, "config.yaml")):
+            return os.path.join(candidate, "config.yaml")
+    return None
+
+
+def run_fingerprint(
+    snake_command, configfile=None, snakefile_path=None, profile=None, workflow_profile=None, tables=None
+):
+    """Fingerprint everything that decides what a Snakemake run will do, apart from its input files
+
+    Args:
+        snake_command (list): Snakemake command and arguments
+        configfile (str): Filepath of the (merged) runtime config file
+        snakefile_path (str): Filepath of Snakefile, its includes are also fingerprinted
+        profile (str): Snakemake profile name or directory
+        workflow_profile (str): Snakemake workflow-profile directory
+        tables (list): SampleTables (or their filepaths) that the config refers to
+
+    Returns (dict): Hex digests of the command, config, workflow files, profile and workflow-profile configs, and
+        sample tables
+    """
+    import hashlib
+
+    def _hash_files(paths):
+        digest = hashlib.sha256()
+        for path in paths:
+            digest.update(os.fspath(path).encode() + b"\0")
+            try:
+                with open(path, "rb") as stream:
+                    for block in iter(lambda: stream.read(1 << 20), b""):
+                        digest.update(block)
+            except OSError:
+                digest.update(b"<missing>")
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    # the last --profile on the command line wins, whether it came from profile or snake_args
+    profile_args = [i for i, arg in enumerate(snake_command[:-1]) if arg == "--profile"]
+    if profile_args:
+        profile = snake_command[profile_args[-1] + 1]
+    return {
+        "command": hashlib.sha256("\0".join(snake_command).encode()).hexdigest(),
+        "config": _hash_files([configfile] if configfile else []),
+        "workflow": _hash_files(workflow_files(snakefile_path) if snakefile_path else []),
+        "profile": _hash_files([path for path in [_profile_config(profile)] if path]),
+        "workflow_profile": _hash_files([os.path.join(workflow_profile, "config.yaml")] if workflow_profile else []),
+        "sample_tables": _hash_files(tables or []),
+    }
+
+
+def build_snakemake_command(
     configfile=None,
     system_config=None,
     snakefile_path=None,
     merge_config=None,
+    verbose_config=False,
     threads=1,
+    mem_mb=None,
     use_conda=False,
     conda_prefix=None,
     snake_default=None,
@@ -212,16 +2169,21 @@ def run_snakemake(
     workflow_profile=None,
     system_workflow_profile=None,
     log=None,
+    phase_times=None,
     **kwargs,
 ):
-    """Run a Snakefile!
+    """Prepare the config files and build the Snakemake command for a run
 
     Args:
         configfile (str): Filepath of config file to pass with --configfile
         system_config (str): Filepath of system config to copy if configfile not present
         snakefile_path (str): Filepath of Snakefile
-        merge_config (dict): Config values to merge with your config file
-        threads (int): Number of local threads to request
+        merge_config (dict): Config values to merge with your config file, SampleTable values are validated, indexed
+            and written to the config by path
+        verbose_config (bool): Display the full runtime config, instead of a size-limited summary of the values that
+            differ from system_config
+        threads (int | str): Number of local threads to request, or "auto" for the CPUs available to this process
+        mem_mb (int | str): Memory to pass with --resources mem_mb=, or "auto" for the cgroup memory limit
         use_conda (bool): Snakemake's --use-conda
         conda_prefix (str): Filepath for Snakemake's --conda-prefix
         snake_default (list): Snakemake args to pass to Snakemake
@@ -230,35 +2192,89 @@ def run_snakemake(
         workflow_profile (str): Name of Snakemake workflow-profile
         system_workflow_profile (str): Filepath of system workflow-profile config.yaml to copy if not present
         log (str): Log file for writing STDERR
+        phase_times (dict): Dictionary to add the seconds spent in each phase of preparing the run to
         **kwargs:
 
-    Returns (int): Exit code
+    Returns (list): Snakemake command and arguments, raising ValueError if a SampleTable is invalid
     """
+    import yaml
 
     snake_command = ["snakemake", "-s", snakefile_path]
 
     # if using a configfile
     if configfile:
-        # copy sys default config if not present
-        copy_config(configfile, system_config=system_config, log=log)
+        # validate and index sample tables, which are written to the config by path
+        tables = sample_tables(merge_config) if merge_config else []
+        if tables:
+            with _timed_phase(phase_times, "sample_tables"):
+                for table in tables:
+                    try:
+                        table.index()
+                    except (OSError, ValueError) as error:
+                        raise ValueError(f"Invalid sample table {table.path}: {error}") from error
+                    msg(
+                        f"Using sample table {table.path} with {len(table)} samples",
+                        log=log,
+                        event="sample_table",
+                        table=table.path,
+                        samples=len(table),
+                    )
 
-        if merge_config:
-            update_config(in_config=configfile, merge=merge_config, log=log)
+        # copy sys default config if not present, merging new values straight into the copy
+        with _timed_phase(phase_times, "config_copy"):
+            snake_config, defaults = _copy_config(configfile, merge_config, system_config, log)
+
+        # otherwise merge new values into the existing config
+        if merge_config and snake_config is None:
+            with _timed_phase(phase_times, "config_merge"):
+                snake_config = update_config(in_config=configfile, merge=merge_config, log=log).config
 
         snake_command += ["--configfile", configfile]
 
-        # display the runtime configuration
-        snake_config = read_config(configfile)
-        msg_box(
-            "Runtime config",
-            errmsg=yaml.dump(snake_config, Dumper=yaml.Dumper),
-            log=log,
-        )
+        # display the runtime configuration, only reading the config if it isn't already loaded, and the system config
+        # for the summary's defaults if copy_config didn't just read it
+        with _timed_phase(phase_times, "config_display"):
+            if snake_config is None:
+                snake_config = read_config(configfile)
+            if verbose_config:
+                msg_box(
+                    "Runtime config",
+                    errmsg=yaml.dump(snake_config, Dumper=config_dumper()),
+                    log=log,
+                    event="runtime_config",
+                    config=configfile,
+                )
+            elif system_config and os.path.isfile(system_config):
+                if defaults is None:
+                    defaults = read_config(system_config)
+                msg_box(
+                    f"Runtime config (changes from {system_config})",
+                    errmsg=config_summary(snake_config, defaults=defaults),
+                    log=log,
+                    event="runtime_config",
+                    config=configfile,
+                )
+            else:
+                msg_box(
+                    "Runtime config",
+                    errmsg=config_summary(snake_config),
+                    log=log,
+                    event="runtime_config",
+                    config=configfile,
+                )
 
     # add threads
     if "--profile" not in snake_args and profile is None:
+        if threads == "auto":
+            threads = available_cores()
         snake_command += ["--cores", threads]
 
+    # add memory
+    if mem_mb == "auto":
+        mem_mb = available_memory_mb()
+    if mem_mb and "--resources" not in snake_args:
+        snake_command += ["--resources", f"mem_mb={mem_mb}"]
+
     # add conda args if using conda
     if use_conda:
         snake_command += ["--use-conda"]
@@ -280,16 +2296,463 @@ def run_snakemake(
     # allow double-handling of --workflow-profile
     if workflow_profile:
         # copy system default if not present
-        copy_config(os.path.join(workflow_profile, "config.yaml"), system_config=system_workflow_profile, log=log)
+        with _timed_phase(phase_times, "config_copy"):
+            copy_config(os.path.join(workflow_profile, "config.yaml"), system_config=system_workflow_profile, log=log)
 
         snake_command += ["--workflow-profile", workflow_profile]
 
+    return [str(s) for s in snake_command]
+
+
+def run_snakemake(
+    configfile=None,
+    system_config=None,
+    snakefile_path=None,
+    merge_config=None,
+    verbose_config=False,
+    threads=1,
+    mem_mb=None,
+    use_conda=False,
+    conda_prefix=None,
+    snake_default=None,
+    snake_args=[],
+    profile=None,
+    workflow_profile=None,
+    system_workflow_profile=None,
+    log=None,
+    conda_prewarm=False,
+    batch_rule=None,
+    batches=None,
+    batch_concurrency=1,
+    skip_unchanged=False,
+    force_run=False,
+    fingerprint_file=None,
+    progress_prometheus=None,
+    progress_status=None,
+    progress_interval=15.0,
+    log_per_run=False,
+    **kwargs,
+):
+    """Run a Snakefile!
+
+    Args:
+        configfile (str): Filepath of config file to pass with --configfile
+        system_config (str): Filepath of system config to copy if configfile not present
+        snakefile_path (str): Filepath of Snakefile
+        merge_config (dict): Config values to merge with your config file, SampleTable values are validated, indexed
+            and written to the config by path
+        verbose_config (bool): Display the full runtime config, instead of a size-limited summary of the values that
+            differ from system_config
+        threads (int | str): Number of local threads to request, or "auto" for the CPUs available to this process
+        mem_mb (int | str): Memory to pass with --resources mem_mb=, or "auto" for the cgroup memory limit
+        use_conda (bool): Snakemake's --use-conda
+        conda_prefix (str): Filepath for Snakemake's --conda-prefix
+        snake_default (list): Snakemake args to pass to Snakemake
+        snake_args (list): Additional args to pass to Snakemake
+        profile (str): Name of Snakemake profile
+        workflow_profile (str): Name of Snakemake workflow-profile
+        system_workflow_profile (str): Filepath of system workflow-profile config.yaml to copy if not present
+        log (str): Log file for writing STDERR, Snakemake's output is also copied here, and a JSON run report of
+            timings and Snakemake's resource usage is written next to it before any exit (see run_report_path)
+        conda_prewarm (bool): With use_conda and conda_prefix, create the conda environments before the main run,
+            skipping this if every environment file has already been created (see prewarm_conda_envs)
+        batch_rule (str): Aggregating rule to shard the run on, with Snakemake's --batch (see run_sharded)
+        batches (int): Number of --batch shards to split batch_rule's input files into
+        batch_concurrency (int): Maximum number of shards to run at once
+        skip_unchanged (bool): Skip running Snakemake if the config, workflow files, profiles and command are unchanged
+            since the last successful run (changes to input files are not checked)
+        force_run (bool): Run Snakemake even if skip_unchanged finds nothing has changed
+        fingerprint_file (str): Filepath for storing the fingerprint of the last successful run (default:
+            .snaketool_fingerprint.json next to configfile, or in the working directory)
+        progress_prometheus (str): Filepath of a Prometheus textfile-collector file to write live progress, throughput
+            and ETA metrics to while Snakemake runs (see ProgressMonitor)
+        progress_status (str): Filepath of a JSON status file to write live progress, throughput and ETA to
+        progress_interval (float): Minimum seconds between progress metric writes
+        log_per_run (bool): Rotate the existing log out of the way first, so each run starts a new log (see rotate_log)
+        **kwargs:
+
+    Returns (int): Exit code
+    """
+    import json
+    import shlex
+
+    if log and log_per_run:
+        rotate_log(log)
+    start_time = time()
+    start = monotonic()
+    phase_times = {}
+    # measured for Snakemake's own process (and its jobs), not every child this process has had
+    usage = {}
+
+    def _write_report(command, returncode):
+        # write the run report next to the log file
+        if log:
+            write_run_report(
+                {
+                    "command": command,
+                    "returncode": returncode,
+                    "start_time": strftime("%Y-%m-%dT%H:%M:%S%z", localtime(start_time)),
+                    "wall_time": monotonic() - start,
+                    "user_time": usage.get("user_time"),
+                    "system_time": usage.get("system_time"),
+                    "max_rss_bytes": usage.get("max_rss_bytes"),
+                    "phases": phase_times,
+                },
+                run_report_path(log),
+            )
+
+    try:
+        snake_command = build_snakemake_command(
+            configfile=configfile,
+            system_config=system_config,
+            snakefile_path=snakefile_path,
+            merge_config=merge_config,
+            verbose_config=verbose_config,
+            threads=threads,
+            mem_mb=mem_mb,
+            use_conda=use_conda,
+            conda_prefix=conda_prefix,
+            snake_default=snake_default,
+            snake_args=snake_args,
+            profile=profile,
+            workflow_profile=workflow_profile,
+            system_workflow_profile=system_workflow_profile,
+            log=log,
+            phase_times=phase_times,
+            **kwargs,
+        )
+    except ValueError as error:
+        msg(f"ERROR: {error}", log=log)
+        _write_report(None, 1)
+        if isinstance(log, LogSink):
+            log.flush()
+        sys.exit(1)
+
+    # skip Snakemake if nothing has changed since the last successful run
+    if skip_unchanged:
+        if fingerprint_file is None:
+            fingerprint_file = os.path.join(os.path.dirname(configfile or ""), ".snaketool_fingerprint.json")
+        fingerprint = run_fingerprint(
+            snake_command,
+            configfile=configfile,
+            snakefile_path=snakefile_path,
+            profile=profile,
+            workflow_profile=workflow_profile,
+            tables=sample_tables(merge_config) if merge_config else None,
+        )
+        try:
+            with open(fingerprint_file, "r") as stream:
+                previous = json.load(stream)
+        except (OSError, ValueError):
+            previous = None
+        if previous == fingerprint and not force_run:
+            msg(
+                "Config, workflow, profiles and Snakemake command are unchanged since the last successful run, "
+                "skipping Snakemake",
+                log=log,
+            )
+            return 0
+        # forget the last successful run in case this one fails
+        if previous is not None:
+            os.remove(fingerprint_file)
+
+    # create conda environments ahead of the main run
+    if conda_prewarm and use_conda and conda_prefix:
+        with _timed_phase(phase_times, "conda_prewarm"):
+            if not prewarm_conda_envs(snake_command, snakefile_path, conda_prefix, log=log) == 0:
+                msg("ERROR: Creating conda environments failed", log=log)
+                _write_report(snake_command, 1)
+                if isinstance(log, LogSink):
+                    log.flush()
+                sys.exit(1)
+
     # Run Snakemake!!!
-    snake_command = " ".join(str(s) for s in snake_command)
-    msg_box("Snakemake command", errmsg=snake_command, log=log)
-    if not subprocess.run(snake_command, shell=True).returncode == 0:
-        msg("ERROR: Snakemake failed", log=log)
+    msg_box("Snakemake command", errmsg=shlex.join(snake_command), log=log, event="command", command=snake_command)
+    if isinstance(log, LogSink):
+        log.flush()
+    monitor = None
+    if progress_prometheus or progress_status:
+        monitor = ProgressMonitor(progress_prometheus, progress_status, interval=progress_interval)
+    with _timed_phase(phase_times, "snakemake"):
+        try:
+            if batch_rule and batches:
+                returncode = run_sharded(
+                    snake_command,
+                    batch_rule,
+                    batches,
+                    concurrency=batch_concurrency,
+                    log=log,
+                    monitor=monitor,
+                    usage=usage,
+                )
+            else:
+                returncode = run_command(snake_command, log=log, monitor=monitor, usage=usage)
+        finally:
+            if monitor is not None:
+                monitor.close(log=log)
+
+    _write_report(snake_command, returncode)
+
+    if not returncode == 0:
+        msg("ERROR: Snakemake failed", log=log, event="finished", returncode=returncode)
+        if isinstance(log, LogSink):
+            log.flush()
         sys.exit(1)
     else:
-        msg("Snakemake finished successfully", log=log)
+        msg("Snakemake finished successfully", log=log, event="finished", returncode=returncode)
+        if skip_unchanged:
+            with atomic_write(fingerprint_file) as stream:
+                json.dump(fingerprint, stream, indent=2)
+    if isinstance(log, LogSink):
+        log.flush()
     return 0
+
+
+BatchResult = collections.namedtuple("BatchResult", ["spec", "returncode", "threads", "elapsed"])
+
+
+def _run_batch_spec(spec):
+    """Run one run_snakemake spec in a batch worker, returning the exit code instead of exiting"""
+    start = monotonic()
+    try:
+        returncode = run_snakemake(**spec)
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        msg(f"ERROR: {type(e).__name__}: {e}", log=spec.get("log"))
+        returncode = 1
+    return returncode, monotonic() - start
+
+
+def run_snakemake_batch(runs, cores=None, log=None):
+    """Run several Snakefiles concurrently, sharing a node-wide core budget between them
+
+    Runs are launched in order in a process pool. Each run gets the number of cores it asks for with "threads" (1 if
+    it doesn't ask, as with run_snakemake, or an equal share of the budget for "auto"), capped at the budget, and is
+    queued until that many cores are free. Cores are returned to the budget as runs finish and given to queued runs.
+    Runs are not stopped when another run fails. Run specs are passed to a worker process, so their log must be a
+    filepath, not a LogSink. A run that can't be passed to a worker, or whose worker dies (e.g. killed for running out
+    of memory), gets exit code 1 and its error is logged, without losing the results of the other runs.
+
+    Args:
+        runs (list): Dictionaries of run_snakemake arguments, one per run
+        cores (int): Total cores to share between concurrent runs (default: available_cores())
+        log (str): Log file for writing the batch progress
+
+    Returns (list): BatchResult for each run, in the order of runs
+    """
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    if cores is None:
+        cores = available_cores()
+    default_threads = max(1, cores // max(1, len(runs)))
+    queue = collections.deque(enumerate(runs))
+    results = [None] * len(runs)
+    running = {}
+    available = cores
+    with ProcessPoolExecutor(max_workers=max(1, min(cores, len(runs)))) as pool:
+        while queue or running:
+            while queue:
+                index, spec = queue[0]
+                threads = spec.get("threads", 1)
+                threads = default_threads if threads == "auto" else int(threads)
+                threads = max(1, min(threads, cores))
+                if threads > available:
+                    break
+                queue.popleft()
+                msg(f"Launching run {index + 1} of {len(runs)} with {threads} of {cores} cores", log=log)
+                try:
+                    future = pool.submit(_run_batch_spec, {**spec, "threads": threads})
+                except Exception as error:
+                    # the pool is broken, e.g. after a worker was killed
+                    msg(f"ERROR: Run {index + 1} of {len(runs)} failed: {type(error).__name__}: {error}", log=log)
+                    results[index] = BatchResult(spec, 1, threads, 0.0)
+                    continue
+                available -= threads
+                running[future] = (index, spec, threads, monotonic())
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, spec, threads, start = running.pop(future)
+                available += threads
+                try:
+                    returncode, elapsed = future.result()
+                except Exception as error:
+                    # e.g. a spec that can't be pickled, or a worker that died
+                    msg(f"ERROR: Run {index + 1} of {len(runs)} failed: {type(error).__name__}: {error}", log=log)
+                    returncode, elapsed = 1, monotonic() - start
+                results[index] = BatchResult(spec, returncode, threads, elapsed)
+                msg(f"Run {index + 1} of {len(runs)} exited with code {returncode} after {elapsed:.1f}s", log=log)
+    return results
+
+
+SnakemakeResult = collections.namedtuple("SnakemakeResult", ["command", "returncode", "elapsed", "timed_out"])
+
+# run_snakemake arguments that async_run_snakemake doesn't support
+_SYNC_ONLY_RUN_ARGS = (
+    "conda_prewarm",
+    "batch_rule",
+    "batches",
+    "batch_concurrency",
+    "skip_unchanged",
+    "force_run",
+    "fingerprint_file",
+)
+
+
+async def _async_tee_stream(stream, err, output, chunk_size):
+    """Copy an asyncio subprocess stream to an _OutputCopy a line (or chunk_size characters) at a time"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    partial = ""
+    while True:
+        chunk = await stream.read(chunk_size)
+        if not chunk:
+            break
+        text = partial + decoder.decode(chunk)
+        lines = text.split("\n")
+        partial = lines.pop()
+        for line in lines:
+            output.write(line + "\n", err)
+        # hold back at most chunk_size characters of an unfinished line
+        while len(partial) >= chunk_size:
+            output.write(partial[:chunk_size], err)
+            partial = partial[chunk_size:]
+    output.write(partial + decoder.decode(b"", final=True), err)
+
+
+async def _terminate_process_group(process, grace):
+    """SIGTERM a subprocess's process group, then SIGKILL it if it hasn't exited after grace seconds"""
+    import asyncio
+    import signal
+
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), grace)
+        except asyncio.TimeoutError:
+            os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    await process.wait()
+
+
+async def async_run_snakemake(
+    timeout=None,
+    terminate_grace=10,
+    chunk_size=65536,
+    log=None,
+    progress_prometheus=None,
+    progress_status=None,
+    progress_interval=15.0,
+    log_per_run=False,
+    **kwargs,
+):
+    """Run a Snakefile from asyncio, e.g. to supervise many concurrent runs from one controller
+
+    Takes the same arguments as run_snakemake, except conda_prewarm, batch_rule, batches, batch_concurrency,
+    skip_unchanged, force_run and fingerprint_file, which raise TypeError. Snakemake runs in its own process group,
+    which is terminated (SIGTERM, then SIGKILL after terminate_grace seconds) if the run times out, the task is
+    cancelled, or reading its output fails. Snakemake's output is copied to the terminal, the log and any progress
+    files as it arrives, carrying on with the others if one fails (as with run_command). Unless the task is cancelled,
+    a run report is written next to the log as with run_snakemake. Its user_time, system_time and max_rss_bytes are
+    None, as other runs supervised by the same process can't be told apart. Unlike run_snakemake, failures are
+    returned rather than exiting.
+
+    Args:
+        timeout (float): Seconds to allow Snakemake to run before terminating it
+        terminate_grace (float): Seconds to wait after SIGTERM before sending SIGKILL
+        chunk_size (int): Maximum bytes to read from Snakemake's output at a time
+        log (str | LogSink): Filepath to log file, or LogSink, for writing
+        progress_prometheus (str): Filepath of a Prometheus textfile-collector file to write live progress to
+        progress_status (str): Filepath of a JSON status file to write live progress to
+        progress_interval (float): Minimum seconds between progress metric writes
+        log_per_run (bool): Rotate the existing log out of the way first, so each run starts a new log
+        **kwargs: Arguments for build_snakemake_command
+
+    Returns (SnakemakeResult): Command (None if it couldn't be built), exit code, elapsed seconds, and whether the
+        run timed out
+    """
+    import asyncio
+    import shlex
+    import subprocess
+
+    unsupported = sorted(set(kwargs) & set(_SYNC_ONLY_RUN_ARGS))
+    if unsupported:
+        raise TypeError(f"async_run_snakemake() doesn't support: {', '.join(unsupported)}")
+    if log and log_per_run:
+        rotate_log(log)
+    start_time = time()
+    launch = monotonic()
+    phase_times = {}
+    try:
+        snake_command = await asyncio.to_thread(build_snakemake_command, log=log, phase_times=phase_times, **kwargs)
+    except ValueError as error:
+        msg(f"ERROR: {error}", log=log)
+        return SnakemakeResult(None, 1, 0.0, False)
+    msg_box("Snakemake command", errmsg=shlex.join(snake_command), log=log, event="command", command=snake_command)
+    start = monotonic()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *snake_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True
+        )
+    except FileNotFoundError:
+        msg(f"ERROR: command not found: {snake_command[0]}", log=log)
+        return SnakemakeResult(snake_command, 127, monotonic() - start, False)
+    sink = log if isinstance(log, LogSink) else (LogSink(log) if log else None)
+    monitor = None
+    if progress_prometheus or progress_status:
+        monitor = ProgressMonitor(progress_prometheus, progress_status, interval=progress_interval)
+    output = _OutputCopy(sink, monitor)
+    readers = asyncio.gather(
+        _async_tee_stream(process.stdout, False, output, chunk_size),
+        _async_tee_stream(process.stderr, True, output, chunk_size),
+    )
+    waiter = asyncio.ensure_future(process.wait())
+    timed_out = False
+    try:
+        await asyncio.wait([waiter, readers], timeout=timeout, return_when=asyncio.FIRST_EXCEPTION)
+        if readers.done() and readers.exception() is not None:
+            # a pipe is no longer being drained, so Snakemake could block on it forever
+            msg(f"ERROR: Reading Snakemake's output failed, terminating: {readers.exception()}", log=sink)
+            await _terminate_process_group(process, terminate_grace)
+        else:
+            if not waiter.done():
+                timed_out = True
+                msg(f"ERROR: Snakemake timed out after {timeout} seconds, terminating", log=sink)
+                await _terminate_process_group(process, terminate_grace)
+            await readers
+        output.report()
+    except asyncio.CancelledError:
+        readers.cancel()
+        waiter.cancel()
+        msg("Snakemake run cancelled, terminating", log=sink)
+        await _terminate_process_group(process, terminate_grace)
+        raise
+    finally:
+        if monitor is not None:
+            monitor.close(log=sink)
+        if sink is log:
+            if sink:
+                sink.flush()
+        else:
+            sink.close()
+    elapsed = monotonic() - start
+    phase_times["snakemake"] = elapsed
+    if log:
+        write_run_report(
+            {
+                "command": snake_command,
+                "returncode": process.returncode,
+                "start_time": strftime("%Y-%m-%dT%H:%M:%S%z", localtime(start_time)),
+                "wall_time": monotonic() - launch,
+                "user_time": None,
+                "system_time": None,
+                "max_rss_bytes": None,
+                "phases": phase_times,
+            },
+            run_report_path(log),
+        )
+    if process.returncode == 0:
+        msg("Snakemake finished successfully", log=log, event="finished", returncode=process.returncode)
+    else:
+        msg("ERROR: Snakemake failed", log=log, event="finished", returncode=process.returncode)
+    return SnakemakeResult(snake_command, process.returncode, elapsed, timed_out)
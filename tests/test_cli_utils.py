@@ -1,23 +1,59 @@
 import click
 from click.testing import CliRunner
 import sys
+import os
+import json
+import subprocess
+import asyncio
+import multiprocessing
+import threading
+import time
 import pytest
 from io import StringIO
-from unittest.mock import patch, MagicMock, call
+from unittest.mock import patch, MagicMock, ANY, call
 
 from snaketool_utils.cli_utils import (
+    config_summary,
     OrderedCommands,
+    LazyOrderedCommands,
+    profile_command,
+    ConfigCache,
+    ConfigUpdate,
+    LogSink,
     echo_click,
     msg,
     msg_box,
     read_config,
     recursive_merge_config,
+    merged_config,
     initialise_config,
     write_config,
     update_config,
     copy_config,
     run_snakemake,
+    run_command,
+    async_run_snakemake,
+    SnakemakeResult,
+    run_snakemake_batch,
+    build_snakemake_command,
+    cgroup_cpu_limit,
+    cgroup_memory_limit,
+    available_cores,
+    available_memory_mb,
+    run_report_path,
+    workflow_files,
+    conda_env_files,
     tuple_to_list,
+    yaml_backend,
+    config_dumper,
+    config_fingerprint,
+    config_lock,
+    lock_path,
+    ProgressMonitor,
+    SampleTable,
+    sample_tables,
+    rotate_log,
+    log_segments,
 )
 
 
@@ -49,6 +85,162 @@ def test_list_commands_preserves_order():
     assert "Commands:\n  command1\n  command2\n  command3" in result.output
 
 
+LAZY_CLI = """
+import click
+from snaketool_utils.cli_utils import LazyOrderedCommands
+
+
+@click.group(cls=LazyOrderedCommands, lazy_subcommands={
+    "run": ("heavy_run:run", "Run the pipeline"),
+    "config": "light_config:config",
+})
+def cli():
+    pass
+
+
+@cli.command()
+def citation():
+    \"\"\"Print the citation\"\"\"
+
+
+cli()
+"""
+
+HEAVY_RUN = """
+import click
+import heavy_dependency
+
+
+@click.command()
+def run():
+    \"\"\"Run the pipeline with a much longer description\"\"\"
+    click.echo("running")
+"""
+
+LIGHT_CONFIG = """
+import click
+
+
+@click.command()
+def config():
+    \"\"\"Copy the config file\"\"\"
+"""
+
+
+@pytest.fixture(scope="function")
+def lazy_cli(tmp_path):
+    (tmp_path / "cli.py").write_text(LAZY_CLI)
+    (tmp_path / "heavy_run.py").write_text(HEAVY_RUN)
+    (tmp_path / "light_config.py").write_text(LIGHT_CONFIG)
+    (tmp_path / "heavy_dependency.py").write_text("import time\ntime.sleep(0.5)\n")
+
+    def run(*args):
+        return subprocess.run(
+            [sys.executable, "-X", "importtime", str(tmp_path / "cli.py"), *args],
+            cwd=tmp_path, capture_output=True, text=True,
+        )
+
+    return run
+
+
+def test_lazy_ordered_commands_help(lazy_cli):
+    result = lazy_cli("--help")
+    assert result.returncode == 0
+    commands = result.stdout.split("Commands:\n")[1].splitlines()
+    assert [line.split(maxsplit=1) for line in commands] == [
+        ["run", "Run the pipeline"], ["config", "Copy the config file"], ["citation", "Print the citation"]
+    ]
+    # -X importtime reports imported modules on STDERR; the heavy subcommand must not be imported
+    assert "heavy_run" not in result.stderr
+    assert "heavy_dependency" not in result.stderr
+
+
+def test_lazy_ordered_commands_invoke(lazy_cli):
+    result = lazy_cli("run")
+    assert result.returncode == 0
+    assert result.stdout == "running\n"
+    assert "heavy_dependency" in result.stderr
+
+    result = lazy_cli("run", "--help")
+    assert "Run the pipeline with a much longer description" in result.stdout
+
+
+def test_lazy_ordered_commands_complete():
+    @click.command()
+    def eager():
+        pass
+
+    cli = LazyOrderedCommands(lazy_subcommands={"lazy": ("not_a_real_module:cmd", "Lazy help")})
+    cli.add_command(eager)
+    ctx = click.Context(cli)
+    assert cli.list_commands(ctx) == ["lazy", "eager"]
+    completions = cli.shell_complete(ctx, "")
+    assert [(item.value, item.help) for item in completions] == [("lazy", "Lazy help"), ("eager", "")]
+
+
+def test_profile_command(tmp_path, monkeypatch):
+    @click.command()
+    @click.option("--n", default=1000)
+    @profile_command
+    def work(n):
+        click.echo(sum(range(n)))
+
+    runner = CliRunner()
+    result = runner.invoke(work, ["--n", "10"])
+    assert result.exit_code == 0
+    assert "profile" not in result.output
+    assert list(tmp_path.iterdir()) == []
+
+    prefix = str(tmp_path / "work")
+    result = runner.invoke(work, ["--n", "10"], env={"SNAKETOOL_PROFILE": "all", "SNAKETOOL_PROFILE_OUTPUT": prefix})
+    assert result.exit_code == 0
+    assert "45" in result.output
+    assert "CPU profile written to" in result.output
+    assert "Memory profile written to" in result.output
+    assert os.path.isfile(prefix + ".prof")
+    assert os.path.isfile(prefix + ".memory.txt")
+
+
+def test_profile_command_on_click_command(tmp_path):
+    @profile_command
+    @click.command()
+    def exits():
+        sys.exit(3)
+
+    prefix = str(tmp_path / "exits")
+    result = CliRunner().invoke(exits, env={"SNAKETOOL_PROFILE": "cpu", "SNAKETOOL_PROFILE_OUTPUT": prefix})
+    assert result.exit_code == 3
+    assert os.path.isfile(prefix + ".prof")
+    assert not os.path.isfile(prefix + ".memory.txt")
+
+
+def test_import_time_budget():
+    import py_compile
+    import snaketool_utils.cli_utils as cli_utils
+
+    # time the import from bytecode, as an installed package would be
+    try:
+        py_compile.compile(cli_utils.__file__, doraise=True)
+    except (OSError, py_compile.PyCompileError):
+        pass
+    script = (
+        "from snaketool_utils.cli_utils import msg, msg_box, echo_click, OrderedCommands\n"
+        "import sys\n"
+        "print(' '.join(sys.modules))"
+    )
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", script], capture_output=True, text=True)
+    assert result.returncode == 0
+    modules = result.stdout.split()
+    for heavy in ("yaml", "subprocess", "shutil", "asyncio", "concurrent.futures", "multiprocessing", "json"):
+        assert heavy not in modules
+    cumulative = {}
+    for line in result.stderr.splitlines()[1:]:
+        _, micros, module = line.split("|")
+        cumulative[module.strip()] = int(micros)
+    # everything snaketool_utils imports beyond click should cost well under the time of importing click
+    assert cumulative["snaketool_utils.cli_utils"] - cumulative["click"] < 30000
+
+
 def test_echo_click(capsys, tmp_path):
     # Redirect stderr to capture the output
     sys.stderr = StringIO()
@@ -80,9 +272,11 @@ def test_msg(capsys, tmp_path):
     err_message = "This is an error message"
     log_file = tmp_path / "log.txt"
 
-    # Patch the strftime function to return a fixed timestamp
+    # Patch the strftime function to return a fixed timestamp, clearing the cached timestamps
     fixed_timestamp = "[2022:01:01 00:00:00] "
-    with patch("snaketool_utils.cli_utils.strftime", return_value=fixed_timestamp):
+    with patch("snaketool_utils.cli_utils.strftime", return_value=fixed_timestamp), patch(
+        "snaketool_utils.cli_utils._timestamp_cache", (None, "", "", "")
+    ):
         # Call the msg function
         msg(err_message, log=log_file)
 
@@ -112,6 +306,105 @@ def test_msg_box(capsys, tmp_path):
     assert errmsg in captured.err
 
 
+def test_structured_log(capsys, tmp_path, monkeypatch):
+    monkeypatch.setenv("SNAKETOOL_RUN_ID", "run1")
+    log_file = tmp_path / "log.jsonl"
+    with LogSink(log_file, structured=True) as sink:
+        msg("Starting", log=sink, config="config.yaml")
+        msg("ERROR: Snakemake failed", log=sink)
+        msg_box("Snakemake command", errmsg="snakemake -s Snakefile", log=sink, command=["snakemake"])
+        echo_click("raw output\n", log=sink)
+    captured = capsys.readouterr()
+    assert "] Starting\n" in captured.err
+    assert "| Snakemake command |" in captured.err and "snakemake -s Snakefile" in captured.err
+
+    events = [json.loads(line) for line in log_file.read_text().splitlines()]
+    assert [(e["level"], e["event"], e["message"]) for e in events] == [
+        ("INFO", "message", "Starting"),
+        ("ERROR", "message", "ERROR: Snakemake failed"),
+        ("INFO", "message", "Snakemake command"),
+        ("INFO", "output", "raw output"),
+    ]
+    assert all(e["run_id"] == "run1" for e in events)
+    assert events[0]["config"] == "config.yaml"
+    assert events[2]["command"] == ["snakemake"] and events[2]["detail"] == "snakemake -s Snakefile"
+    assert events[0]["timestamp"][:4].isdigit() and "T" in events[0]["timestamp"]
+
+    # plain filepath logs follow the environment
+    monkeypatch.setenv("SNAKETOOL_LOG_FORMAT", "json")
+    text_log = tmp_path / "log.txt"
+    msg("Hello", log=text_log)
+    assert json.loads(text_log.read_text())["message"] == "Hello"
+    with LogSink(text_log, structured=False) as sink:
+        msg("Plain", log=sink)
+    assert text_log.read_text().splitlines()[-1].endswith("] Plain")
+
+
+def test_structured_log_command_output(tmp_path):
+    log_file = tmp_path / "log.jsonl"
+    with LogSink(log_file, structured=True) as sink:
+        run_command([sys.executable, "-c", "import sys; print('out'); print('err', file=sys.stderr)"], log=sink)
+    events = sorted((e["stream"], e["message"]) for e in map(json.loads, log_file.read_text().splitlines()))
+    assert events == [("stderr", "err"), ("stdout", "out")]
+
+
+def test_log_sink_buffers_until_flush(capsys, tmp_path):
+    log_file = tmp_path / "log.txt"
+    with LogSink(log_file, flush_interval=3600, flush_size=1 << 20) as sink:
+        msg_box("Splash", errmsg="Some message", log=sink)
+        assert log_file.read_text() == ""
+        sink.flush()
+        flushed = log_file.read_text()
+        assert "| Splash |" in flushed
+        assert "Some message" in flushed
+        echo_click("after flush\n", log=sink)
+    assert sink.closed
+    assert log_file.read_text() == flushed + "after flush\n"
+
+
+def test_log_sink_flush_size(capsys, tmp_path):
+    log_file = tmp_path / "log.txt"
+    sink = LogSink(str(log_file), flush_interval=3600, flush_size=10)
+    echo_click("12345", log=sink)
+    assert log_file.read_text() == ""
+    echo_click("67890", log=sink)
+    assert log_file.read_text() == "1234567890"
+    sink.close()
+
+
+def test_log_sink_flush_interval(capsys, tmp_path):
+    log_file = tmp_path / "log.txt"
+    sink = LogSink(log_file, flush_interval=0.1)
+    echo_click("first\n", log=sink)
+    echo_click("second\n", log=sink)
+    # written by the timer, without another write
+    deadline = time.monotonic() + 10
+    while log_file.read_text() != "first\nsecond\n" and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert log_file.read_text() == "first\nsecond\n"
+    sink.close()
+
+
+def test_log_sink_reopens_after_close(capsys, tmp_path):
+    log_file = tmp_path / "log.txt"
+    sink = LogSink(log_file, flush_interval=0)
+    echo_click("first\n", log=sink)
+    sink.close()
+    echo_click("second\n", log=sink)
+    sink.close()
+    assert log_file.read_text() == "first\nsecond\n"
+
+
+def test_run_snakemake_flushes_log_sink_on_failure(capsys, tmp_path):
+    log_file = tmp_path / "log.txt"
+    sink = LogSink(log_file, flush_interval=3600)
+    with patch("snaketool_utils.cli_utils.run_command", return_value=1):
+        with pytest.raises(SystemExit):
+            run_snakemake(snakefile_path="Snakefile", log=sink)
+    assert "ERROR: Snakemake failed" in log_file.read_text()
+    sink.close()
+
+
 @pytest.fixture(scope="function")
 def temp_left_config(tmp_path):
     file_path = tmp_path / "config.yaml"
@@ -131,6 +424,35 @@ def temp_left_config(tmp_path):
     yield str(file_path), expected_config
 
 
+def test_yaml_backend(monkeypatch):
+    import yaml
+
+    assert yaml_backend("python") == (yaml.SafeLoader, yaml.SafeDumper)
+    if yaml.__with_libyaml__:
+        assert yaml_backend("auto") == (yaml.CSafeLoader, yaml.CSafeDumper)
+        monkeypatch.setenv("SNAKETOOL_YAML_BACKEND", "python")
+        assert yaml_backend() == (yaml.SafeLoader, yaml.SafeDumper)
+    else:
+        assert yaml_backend("auto") == (yaml.SafeLoader, yaml.SafeDumper)
+        with pytest.raises(ImportError):
+            yaml_backend("libyaml")
+    with pytest.raises(ValueError):
+        yaml_backend("nope")
+
+
+@pytest.mark.parametrize("backend", ["python", "libyaml"])
+def test_yaml_backends_round_trip(monkeypatch, tmp_path, backend, left_path, left_config, left_yaml):
+    import yaml
+
+    if backend == "libyaml" and not yaml.__with_libyaml__:
+        pytest.skip("PyYAML not built with LibYAML")
+    monkeypatch.setenv("SNAKETOOL_YAML_BACKEND", backend)
+    assert read_config(left_path) == left_config
+    file_path = tmp_path / "config.yaml"
+    write_config(left_config, file_path)
+    assert file_path.read_text() == left_yaml
+
+
 def test_read_config(temp_left_config):
     file_path, expected_config = temp_left_config
 
@@ -198,7 +520,7 @@ def right_path(tmp_path, right_yaml):
 
 
 @pytest.fixture(scope="function")
-def merged_config():
+def left_right_merged():
     return {
         "key1": "new_value1",
         "key2": {
@@ -234,9 +556,100 @@ def merged_path(tmp_path, merged_yaml):
     return file_path
 
 
-def test_recursive_merge_config(left_config, right_config, merged_config):
+def test_read_config_cache(monkeypatch, tmp_path, left_path, left_config, right_yaml, right_config):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("SNAKETOOL_CONFIG_CACHE", str(cache_dir))
+    assert read_config(left_path) == left_config
+    entries = list(cache_dir.glob("*.pickle"))
+    assert len(entries) == 1
+
+    # a cache hit doesn't parse the YAML
+    with patch("yaml.load") as mock_load:
+        assert read_config(left_path) == left_config
+        mock_load.assert_not_called()
+
+    # changing the file invalidates the cached parse
+    left_path.write_text(right_yaml)
+    assert read_config(left_path) == {**right_config, "key1": "value1"}
+    assert len(list(cache_dir.glob("*.pickle"))) == 2
+
+
+def test_config_cache_corrupt_entry(tmp_path, left_path, left_config):
+    import yaml
+
+    cache = ConfigCache(str(tmp_path / "cache"))
+    cache.read_config(left_path, yaml.SafeLoader)
+    entry = next((tmp_path / "cache").glob("*.pickle"))
+    entry.write_bytes(b"not a pickle")
+    assert cache.read_config(left_path, yaml.SafeLoader) == left_config
+
+
+def test_config_cache_lru_eviction(tmp_path, left_yaml):
+    import yaml
+
+    cache_dir = tmp_path / "cache"
+    cache = ConfigCache(str(cache_dir))
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"config{i}.yaml"
+        path.write_text(left_yaml + f"key{i + 10}: {i}\n")
+        paths.append(path)
+        cache.read_config(path, yaml.SafeLoader)
+        # age each new entry so that config0 is least recently used
+        entry = max(cache_dir.glob("*.pickle"), key=os.path.getmtime)
+        os.utime(entry, (i + 1, i + 1))
+        if i == 1:
+            cache.max_bytes = sum(f.stat().st_size for f in cache_dir.glob("*.pickle"))
+    assert len(list(cache_dir.glob("*.pickle"))) == 2
+    with patch("yaml.load", wraps=yaml.load) as mock_load:
+        cache.read_config(paths[1], yaml.SafeLoader)
+        mock_load.assert_not_called()
+        cache.read_config(paths[0], yaml.SafeLoader)
+        mock_load.assert_called_once()
+
+
+def test_recursive_merge_config(left_config, right_config, left_right_merged):
     recursive_merge_config(left_config, right_config)
-    assert left_config == merged_config
+    assert left_config == left_right_merged
+
+
+def test_recursive_merge_config_deep():
+    depth = sys.getrecursionlimit() * 2
+    config, overwrite = {}, {}
+    node, over = config, overwrite
+    for _ in range(depth):
+        node["a"] = {"keep": 1}
+        over["a"] = {}
+        node, over = node["a"], over["a"]
+    over["new"] = 2
+    recursive_merge_config(config, overwrite)
+    node = config
+    for _ in range(depth - 1):
+        node = node["a"]
+        assert node["keep"] == 1
+    assert node["a"] == {"keep": 1, "new": 2}
+
+
+def test_recursive_merge_config_list_strategy():
+    config = {"samples": ["a", "b"], "other": [1], "nested": {"samples": ["a"]}}
+    overwrite = {"samples": ("b", "c"), "other": [2], "nested": {"samples": ["a", "d"]}}
+    recursive_merge_config(config, overwrite, list_strategy={"samples": "union", ("other",): "append"})
+    assert config == {"samples": ["a", "b", "c"], "other": [1, 2], "nested": {"samples": ["a", "d"]}}
+    with pytest.raises(ValueError):
+        recursive_merge_config({"a": [1]}, {"a": [2]}, list_strategy="nope")
+
+
+def test_merged_config(left_config, right_config, left_right_merged):
+    left_config["key5"] = {"untouched": ["x"]}
+    left_right_merged["key5"] = {"untouched": ["x"]}
+    merged = merged_config(left_config, right_config)
+    assert merged == left_right_merged
+    assert left_config["key1"] == "value1"
+    assert left_config["key2"] == {"nested_key1": "nested_value1", "nested_key2": "nested_value2"}
+    # untouched subtrees are shared rather than copied
+    assert merged["key5"] is left_config["key5"]
+    assert merged["key2"] is not left_config["key2"]
+    assert merged_config({"a": [1, 2]}, {"a": [2, 3]}, list_strategy="union") == {"a": [1, 2, 3]}
 
 
 def test_write_config(left_config, left_yaml, tmp_path):
@@ -260,6 +673,261 @@ def test_copy_config(tmp_path, left_path, right_config, merged_yaml):
         assert f.read() == merged_yaml
 
 
+def test_update_config_returns_merged(tmp_path, left_path, right_config, left_right_merged):
+    file_path = tmp_path / "config.yaml"
+    config, written = update_config(in_config=left_path, merge=right_config, output_config=file_path)
+    assert config == left_right_merged
+    assert written
+    assert read_config(file_path) == left_right_merged
+
+
+def test_update_config_skips_unchanged(tmp_path, left_path, left_config, right_config):
+    mtime = os.stat(left_path).st_mtime_ns
+    with patch("snaketool_utils.cli_utils.write_config") as mock_write_config:
+        update = update_config(in_config=left_path, merge={"key1": "value1", "key2": {}})
+        assert update == ConfigUpdate(left_config, False)
+        mock_write_config.assert_not_called()
+    assert os.stat(left_path).st_mtime_ns == mtime
+
+    file_path = tmp_path / "config.yaml"
+    assert update_config(in_config=left_path, merge=right_config, output_config=file_path).written
+    assert not update_config(in_config=left_path, merge=right_config, output_config=file_path).written
+    assert update_config(in_config=left_path, merge=right_config).written
+
+
+def test_config_fingerprint():
+    assert config_fingerprint({"a": 1, "b": [1, 2]}) == config_fingerprint({"b": [1, 2], "a": 1})
+    assert config_fingerprint({"a": 1}) != config_fingerprint({"a": "1"})
+    assert config_fingerprint({1: "a", "b": 2}) == config_fingerprint({"b": 2, 1: "a"})
+
+
+def test_write_config_atomic(tmp_path, left_config, left_yaml):
+    file_path = tmp_path / "config.yaml"
+    file_path.write_text(left_yaml)
+    with patch("yaml.dump", side_effect=RuntimeError("crash")):
+        with pytest.raises(RuntimeError):
+            write_config({"new": "config"}, file_path)
+    assert file_path.read_text() == left_yaml
+    assert os.listdir(tmp_path) == ["config.yaml"]
+
+
+def test_write_config_permissions(tmp_path, left_config):
+    old_umask = os.umask(0o027)
+    try:
+        # the umask is never changed, even for a moment, as other threads may be creating files
+        with patch("os.umask", side_effect=AssertionError("umask changed")):
+            write_config(left_config, tmp_path / "new.yaml")
+            (tmp_path / "existing.yaml").write_text("")
+            (tmp_path / "existing.yaml").chmod(0o600)
+            write_config(left_config, tmp_path / "existing.yaml")
+    finally:
+        os.umask(old_umask)
+    assert (tmp_path / "new.yaml").stat().st_mode & 0o777 == 0o640
+    assert (tmp_path / "existing.yaml").stat().st_mode & 0o777 == 0o600
+
+
+def test_copy_config_returns_config(tmp_path, left_path, right_config, left_right_merged):
+    file_path = tmp_path / "config.yaml"
+    assert copy_config(file_path, merge_config=right_config, system_config=left_path) == left_right_merged
+    assert copy_config(file_path, merge_config=right_config, system_config=left_path) is None
+    assert copy_config(tmp_path / "plain.yaml", system_config=left_path) is None
+
+
+def _concurrent_copy_config(barrier, results, local_config, system_config, worker):
+    barrier.wait()
+    start = time.monotonic()
+    config = copy_config(local_config, merge_config={"worker": worker}, system_config=system_config)
+    results.put((worker, config, time.monotonic() - start))
+
+
+def _concurrent_update_config(barrier, results, local_config, worker):
+    barrier.wait()
+    start = time.monotonic()
+    update_config(in_config=local_config, merge={"workers": {f"worker{worker}": worker}})
+    results.put((worker, None, time.monotonic() - start))
+
+
+def _run_concurrently(target, args, n_workers=16):
+    ctx = multiprocessing.get_context("fork")
+    barrier = ctx.Barrier(n_workers)
+    results = ctx.Queue()
+    processes = [ctx.Process(target=target, args=(barrier, results, *args, i)) for i in range(n_workers)]
+    for process in processes:
+        process.start()
+    outcomes = [results.get(timeout=60) for _ in processes]
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+    return outcomes
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="requires fcntl and fork")
+def test_copy_config_concurrent(tmp_path, left_path, left_config):
+    local_config = tmp_path / "out" / "config.yaml"
+    outcomes = _run_concurrently(_concurrent_copy_config, (str(local_config), str(left_path)))
+
+    # exactly one process creates the config, and the rest use it without rewriting it
+    created = [(worker, config) for worker, config, _ in outcomes if config is not None]
+    assert len(created) == 1
+    worker, config = created[0]
+    assert config == dict(left_config, worker=worker)
+    assert read_config(local_config) == config
+    assert sorted(os.listdir(local_config.parent)) == [".config.yaml.lock", "config.yaml"]
+    assert max(elapsed for _, _, elapsed in outcomes) < 30
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="requires fcntl and fork")
+def test_update_config_concurrent(tmp_path, left_path, left_config):
+    local_config = tmp_path / "config.yaml"
+    copy_config(local_config, system_config=left_path)
+    outcomes = _run_concurrently(_concurrent_update_config, (str(local_config),))
+
+    # no update is lost to another process rewriting the config at the same time
+    workers = {f"worker{i}": i for i in range(16)}
+    assert read_config(local_config) == dict(left_config, workers=workers)
+    assert max(elapsed for _, _, elapsed in outcomes) < 30
+
+
+def test_config_lock_timeout(tmp_path):
+    file_path = tmp_path / "config.yaml"
+    errors = []
+
+    def other_thread():
+        try:
+            with config_lock(file_path, timeout=0.2):
+                pass
+        except TimeoutError as error:
+            errors.append(error)
+
+    with config_lock(file_path):
+        # re-entrant within a thread
+        with config_lock(file_path, timeout=0):
+            pass
+        start = time.monotonic()
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        thread.join()
+        assert len(errors) == 1
+        assert 0.2 <= time.monotonic() - start < 5
+    with config_lock(file_path, timeout=0):
+        pass
+    assert os.path.isfile(lock_path(file_path))
+
+
+def test_copy_config_exclusive_publish(tmp_path, left_path):
+    file_path = tmp_path / "out" / "config.yaml"
+    original_isfile = os.path.isfile
+
+    def racing_isfile(path):
+        # another process, not holding the lock, creates the config after it was checked
+        if os.fspath(path) == str(file_path) and not original_isfile(file_path):
+            file_path.write_text("other: process\n")
+            return False
+        return original_isfile(path)
+
+    with patch("os.path.isfile", side_effect=racing_isfile):
+        assert copy_config(file_path, merge_config={"new": "value"}, system_config=left_path) is None
+    assert file_path.read_text() == "other: process\n"
+    assert sorted(os.listdir(file_path.parent)) == [".config.yaml.lock", "config.yaml"]
+
+
+def test_run_snakemake_single_config_pass(tmp_path, left_path, right_config, left_right_merged):
+    configfile = tmp_path / "config.yaml"
+    with patch("snaketool_utils.cli_utils.read_config", wraps=read_config) as mock_read_config, patch(
+        "snaketool_utils.cli_utils.write_config", wraps=write_config
+    ) as mock_write_config, patch("subprocess.run") as mock_run:
+        mock_run.return_value.returncode = 0
+        run_snakemake(
+            configfile=str(configfile),
+            system_config=str(left_path),
+            snakefile_path="Snakefile",
+            merge_config=right_config,
+        )
+    # the system config parsed to create the config is reused as the summary's defaults
+    mock_read_config.assert_called_once_with(str(left_path))
+    mock_write_config.assert_called_once()
+    assert read_config(configfile) == left_right_merged
+
+
+def test_config_summary_only_shows_changes():
+    import enum
+    import pathlib
+
+    defaults = {"output": "out", "threads": 8, "qc": {"trim": True, "minlen": 50, "adapters": ["a", "b"]}}
+    config = {"output": "out", "threads": 16, "qc": {"trim": True, "minlen": 50, "adapters": ["a", "c"]}}
+    assert config_summary(config, defaults=defaults) == "threads: 16\nqc:\n  adapters:\n  - a\n  - c"
+    assert config_summary(defaults, defaults=defaults) == "(no changes from the default config)"
+    # an empty config file reads as None
+    assert config_summary(None) == "null"
+    assert config_summary(None, defaults=None) == "null"
+    assert config_summary(None, defaults={"a": 1}) == "null"
+    assert config_summary(["a", "b"], max_items=1) == "- a\n- ... (1 more items)"
+    assert config_summary({"a": None, "b": "x: y", "c": False}) == 'a: null\nb: "x: y"\nc: false'
+    Mode = enum.Enum("Mode", ["fast", "sensitive"])
+    assert config_summary({"out": pathlib.Path("results"), "mode": Mode.fast}) == "out: results\nmode: fast"
+
+
+def test_config_summary_is_size_bounded():
+    config = {"samples": {f"sample{i}": {"R1": f"s{i}.fq"} for i in range(1000)}, "reads": list(range(1000))}
+    summary = config_summary(config, max_items=3).splitlines()
+    assert summary == [
+        "samples:",
+        "  sample0:",
+        "    R1: s0.fq",
+        "  sample1:",
+        "    R1: s1.fq",
+        "  sample2:",
+        "    R1: s2.fq",
+        "  ... (997 more keys)",
+        "reads:",
+        "- 0",
+        "- 1",
+        "- 2",
+        "- ... (997 more items)",
+    ]
+    capped = config_summary(config, max_items=1000, max_chars=200)
+    assert len(capped) < 250
+    assert capped.endswith("... (cut off after 200 characters)")
+    deep = current = {}
+    for i in range(5000):
+        current["k"] = current = {}
+    current["leaf"] = 1
+    assert config_summary(deep, max_chars=100).endswith("... (cut off after 100 characters)")
+
+
+def test_run_snakemake_empty_config(tmp_path, left_path, capsys):
+    configfile = tmp_path / "config.yaml"
+    configfile.write_text("")
+    with patch("subprocess.run") as mock_run:
+        mock_run.return_value.returncode = 0
+        assert run_snakemake(configfile=str(configfile), system_config=str(left_path), snakefile_path="Snakefile") == 0
+    assert "null" in capsys.readouterr().err
+
+
+def test_run_snakemake_config_display(tmp_path, left_path, capsys):
+    configfile = tmp_path / "config.yaml"
+    with patch("subprocess.run") as mock_run:
+        mock_run.return_value.returncode = 0
+        run_snakemake(
+            configfile=str(configfile),
+            system_config=str(left_path),
+            snakefile_path="Snakefile",
+            merge_config={"new_key": "new_value"},
+        )
+        summary = capsys.readouterr().err
+        run_snakemake(
+            configfile=str(configfile),
+            system_config=str(left_path),
+            snakefile_path="Snakefile",
+            verbose_config=True,
+        )
+        full = capsys.readouterr().err
+    assert f"Runtime config (changes from {left_path})" in summary
+    assert "new_key: new_value" in summary
+    assert "key1" not in summary
+    assert "key1" in full and "new_key: new_value" in full
+
+
 def test_initialise_config(tmp_path, left_path, left_yaml, right_path, right_yaml):
     config_out = tmp_path / "config.yaml"
     profile_out = tmp_path / "profile"
@@ -298,7 +966,7 @@ def test_run_snakemake(tmp_path):
         f.write("rule all:\n  input: 'output.txt'")
 
     # Patch the copy_config, update_config, read_config, and subprocess.run functions
-    with patch("snaketool_utils.cli_utils.copy_config") as mock_copy_config, patch(
+    with patch("snaketool_utils.cli_utils._copy_config") as mock_copy_config, patch(
         "snaketool_utils.cli_utils.update_config"
     ) as mock_update_config, patch(
         "snaketool_utils.cli_utils.read_config"
@@ -306,6 +974,7 @@ def test_run_snakemake(tmp_path):
         "subprocess.run"
     ) as mock_run:
         # Set the return values and side effects of the mocked functions
+        mock_copy_config.return_value = (None, None)
         mock_read_config.return_value = {"key": "value"}
 
         # Create a MagicMock object to use as the return value of subprocess.run
@@ -326,44 +995,39 @@ def test_run_snakemake(tmp_path):
 
         # Assert that the copy_config function was called with the expected arguments
         mock_copy_config.assert_has_calls([
-            call(configfile, system_config=system_config, log=None),
-            call(workflow_profile_config, system_config=system_workflow_profile, log=None)
+            call(configfile, None, system_config, None),
+            call(workflow_profile_config, None, system_workflow_profile, None)
         ])
 
         # Assert that the update_config function was not called
         mock_update_config.assert_not_called()
 
-        # Assert that the read_config function was called with the configfile
-        mock_read_config.assert_called_once_with(configfile)
+        # Assert that the read_config function was called with the configfile, and the system config for the summary
+        assert mock_read_config.call_args_list == [call(configfile), call(system_config)]
 
         # Assert that the subprocess.run function was called with the expected command
         mock_run.assert_called_once_with(
-            "snakemake -s {} --configfile {} --cores 1 --workflow-profile {}".format(
-                snakefile_path, configfile, workflow_profile
-            ),
-            shell=True,
+            ["snakemake", "-s", snakefile_path, "--configfile", configfile, "--cores", "1", "--workflow-profile",
+             workflow_profile]
         )
 
         # Assert that the exit code is 0
         assert exit_code == 0
 
-    # Patch the copy_config, update_config, read_config, and subprocess.run functions
-    with patch("snaketool_utils.cli_utils.copy_config") as mock_copy_config, patch(
+    # Patch the copy_config, update_config, read_config, and run_command functions
+    with patch("snaketool_utils.cli_utils._copy_config") as mock_copy_config, patch(
         "snaketool_utils.cli_utils.update_config"
     ) as mock_update_config, patch(
         "snaketool_utils.cli_utils.read_config"
     ) as mock_read_config, patch(
-        "subprocess.run"
+        "snaketool_utils.cli_utils.run_command"
     ) as mock_run:
         # Set the return values and side effects of the mocked functions
-        mock_read_config.return_value = {"key": "value"}
-
-        # Create a MagicMock object to use as the return value of subprocess.run
-        mock_run_result = MagicMock()
-        mock_run_result.returncode = 0
+        mock_copy_config.return_value = (None, None)
+        mock_update_config.return_value = ConfigUpdate({"key": "value", "key2": "value2"}, True)
 
-        # Set the return value of subprocess.run to the MagicMock object
-        mock_run.return_value = mock_run_result
+        # Set the exit code returned by run_command
+        mock_run.return_value = 0
 
         # Call the run_snakemake function again with additional arguments
         exit_code = run_snakemake(
@@ -385,27 +1049,547 @@ def test_run_snakemake(tmp_path):
 
         # Assert that the copy_config function was called with the expected arguments
         mock_copy_config.assert_has_calls([
-            call(configfile, system_config=system_config, log=log_file),
-            call(workflow_profile_config, system_config=system_workflow_profile, log=log_file)
+            call(configfile, {"key2": "value2"}, system_config, log_file),
+            call(workflow_profile_config, None, system_workflow_profile, log_file)
         ])
 
         # Assert that the update_config function was called with the expected arguments
-        # mock_update_config.assert_called_once_with(configfile, merge={"key2": "value2"}, log=log_file)
+        mock_update_config.assert_called_once_with(in_config=configfile, merge={"key2": "value2"}, log=log_file)
 
-        # Assert that the read_config function was called with the configfile
-        mock_read_config.assert_called_once_with(configfile)
+        # Assert that the merged config is displayed without re-reading the configfile, only reading the defaults
+        mock_read_config.assert_called_once_with(system_config)
 
-        # Assert that the subprocess.run function was called with the expected command
-        expected_command = "snakemake -s {} --configfile {} --use-conda --conda-prefix /path/to/conda --verbose " \
-                           "--dry-run --profile my_profile --workflow-profile {}".format(
-            snakefile_path, configfile, workflow_profile
-        )
-        mock_run.assert_called_once_with(expected_command, shell=True)
+        # Assert that run_command was called with the expected command and log
+        expected_command = [
+            "snakemake", "-s", snakefile_path, "--configfile", configfile, "--use-conda", "--conda-prefix",
+            "/path/to/conda", "--verbose", "--dry-run", "--profile", "my_profile", "--workflow-profile",
+            workflow_profile
+        ]
+        mock_run.assert_called_once_with(expected_command, log=log_file, monitor=None, usage={})
 
         # Assert that the exit code is 0
         assert exit_code == 0
 
 
+def test_run_command_tees_output(capfd, tmp_path):
+    log_file = tmp_path / "log.txt"
+    script = "import sys; print('out line'); print('err line', file=sys.stderr); print('x' * 100); sys.exit(3)"
+    assert run_command([sys.executable, "-c", script], log=str(log_file), chunk_size=16) == 3
+    captured = capfd.readouterr()
+    assert "out line\n" in captured.out
+    assert "x" * 100 + "\n" in captured.out
+    assert captured.err == "err line\n"
+    log_content = log_file.read_text()
+    assert "out line\n" in log_content
+    assert "err line\n" in log_content
+    assert "x" * 100 + "\n" in log_content
+
+
+_real_echo = click.echo
+
+
+def _echo_stdout_fails(message=None, file=None, nl=True, err=False, **kwargs):
+    """click.echo as if the terminal on STDOUT has gone away"""
+    if not err:
+        raise OSError(5, "Input/output error")
+    _real_echo(message, file=file, nl=nl, err=err, **kwargs)
+
+
+def test_run_command_log_outlives_terminal(capfd, tmp_path):
+    log_file = tmp_path / "log.txt"
+    script = "for i in range(3): print(f'line {i}')"
+    with patch("snaketool_utils.cli_utils.click.echo", side_effect=_echo_stdout_fails):
+        assert run_command([sys.executable, "-c", script], log=str(log_file)) == 0
+    log_content = log_file.read_text()
+    assert "line 0\nline 1\nline 2\n" in log_content
+    # reported once, after the command
+    assert log_content.count("WARNING: Stopped copying the command's output to the terminal") == 1
+    assert log_content.index("line 2") < log_content.index("WARNING")
+
+
+def test_run_command_log_written_while_running(capfd, tmp_path):
+    log_file = tmp_path / "log.txt"
+    stop_file = tmp_path / "stop"
+    script = (
+        "import os, sys, time\nprint('early line', flush=True)\nwhile not os.path.exists(sys.argv[1]): time.sleep(0.05)"
+    )
+    command = [sys.executable, "-c", script, stop_file]
+    runner = threading.Thread(target=run_command, args=(command,), kwargs={"log": str(log_file)})
+    runner.start()
+    # the tee'd line reaches the log while the command is still running quietly, so isn't lost if it is killed
+    deadline = time.monotonic() + 10
+    while not (log_file.exists() and "early line" in log_file.read_text()) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert "early line\n" in log_file.read_text()
+    assert runner.is_alive()
+    stop_file.touch()
+    runner.join()
+
+
+def test_run_command_path_with_spaces(capfd, tmp_path):
+    path = tmp_path / "dir with spaces" / "file.txt"
+    path.parent.mkdir()
+    path.write_text("contents\n")
+    sink = LogSink(tmp_path / "log.txt")
+    assert run_command([sys.executable, "-c", "import sys; print(open(sys.argv[1]).read())", path], log=sink) == 0
+    sink.close()
+    assert "contents" in (tmp_path / "log.txt").read_text()
+    assert run_command(["no-such-command-for-snaketool-utils"]) == 127
+
+
+def test_async_run_snakemake(capfd, tmp_path):
+    log_file = tmp_path / "log.txt"
+    command = [sys.executable, "-c", "import sys; print('snakemake output', file=sys.stderr); sys.exit(2)"]
+    status_file = tmp_path / "status.json"
+    with patch("snaketool_utils.cli_utils.build_snakemake_command", return_value=command) as mock_build:
+        result = asyncio.run(
+            async_run_snakemake(
+                snakefile_path="Snakefile", threads=4, log=str(log_file), progress_status=str(status_file)
+            )
+        )
+    mock_build.assert_called_once_with(snakefile_path="Snakefile", threads=4, log=str(log_file), phase_times=ANY)
+    assert isinstance(result, SnakemakeResult)
+    assert result.command == command
+    assert result.returncode == 2
+    assert not result.timed_out
+    assert "snakemake output" in capfd.readouterr().err
+    log_content = log_file.read_text()
+    assert "snakemake output" in log_content
+    assert "ERROR: Snakemake failed" in log_content
+    assert not json.loads(status_file.read_text())["running"]
+    with open(tmp_path / "log.report.json") as stream:
+        report = json.load(stream)
+    assert (report["command"], report["returncode"], report["max_rss_bytes"]) == (command, 2, None)
+    assert "snakemake" in report["phases"]
+
+    # run_snakemake arguments it can't honour are rejected, not silently dropped
+    with pytest.raises(TypeError, match="batches, skip_unchanged"):
+        asyncio.run(async_run_snakemake(snakefile_path="Snakefile", skip_unchanged=True, batches=4))
+
+
+def test_async_run_snakemake_timeout(capfd, tmp_path):
+    command = [sys.executable, "-c", "import time; time.sleep(60)"]
+    with patch("snaketool_utils.cli_utils.build_snakemake_command", return_value=command):
+        result = asyncio.run(async_run_snakemake(timeout=0.5, terminate_grace=5))
+    assert result.timed_out
+    assert result.returncode != 0
+    assert result.elapsed < 30
+
+
+def test_async_run_snakemake_drains_output(capfd, tmp_path):
+    log_file = tmp_path / "log.txt"
+    # far more output than a pipe buffer holds, while the terminal on STDOUT has gone away
+    command = [sys.executable, "-c", "for i in range(200000): print(f'line {i}')"]
+    with patch("snaketool_utils.cli_utils.build_snakemake_command", return_value=command), patch(
+        "snaketool_utils.cli_utils.click.echo", side_effect=_echo_stdout_fails
+    ):
+        result = asyncio.run(asyncio.wait_for(async_run_snakemake(log=str(log_file)), 60))
+    assert result.returncode == 0
+    log_content = log_file.read_text()
+    assert "line 199999\n" in log_content
+    assert log_content.count("WARNING: Stopped copying the command's output to the terminal") == 1
+
+
+def test_async_run_snakemake_logs_lines(capfd, tmp_path):
+    # output arriving in pieces is logged a line at a time, as by run_command
+    script = (
+        "import sys, time\n"
+        "for i in range(5):\n"
+        "    for part in ('line', ' ', str(i), '\\n'):\n"
+        "        sys.stdout.write(part); sys.stdout.flush(); time.sleep(0.01)\n"
+        "sys.stdout.write('no newline'); sys.stdout.flush()"
+    )
+    command = [sys.executable, "-c", script]
+    expected = [f"line {i}" for i in range(5)] + ["no newline"]
+    with LogSink(tmp_path / "sync.log", structured=True) as sink:
+        run_command(command, log=sink)
+    with patch("snaketool_utils.cli_utils.build_snakemake_command", return_value=command):
+        with LogSink(tmp_path / "async.log", structured=True) as sink:
+            asyncio.run(async_run_snakemake(log=sink))
+    for log_file in ("sync.log", "async.log"):
+        events = [json.loads(line) for line in (tmp_path / log_file).read_text().splitlines()]
+        assert [event["message"] for event in events if event["event"] == "output"] == expected
+
+
+def test_async_run_snakemake_reader_fails(capfd, tmp_path):
+    command = [sys.executable, "-c", "import time; time.sleep(60)"]
+
+    async def failing_reader(stream, err, output, chunk_size):
+        raise RuntimeError("reader failed")
+
+    with patch("snaketool_utils.cli_utils.build_snakemake_command", return_value=command), patch(
+        "snaketool_utils.cli_utils._async_tee_stream", failing_reader
+    ):
+        result = asyncio.run(asyncio.wait_for(async_run_snakemake(terminate_grace=5), 30))
+    assert result.returncode != 0
+    assert result.elapsed < 30
+    assert "Reading Snakemake's output failed, terminating: reader failed" in capfd.readouterr().err
+
+
+def test_async_run_snakemake_cancel(capfd, tmp_path):
+    pid_file = tmp_path / "pid"
+    command = [sys.executable, "-c", f"import os, time; open({str(pid_file)!r}, 'w').write(str(os.getpid())); "
+                                     "time.sleep(60)"]
+
+    async def cancel_run():
+        task = asyncio.create_task(async_run_snakemake())
+        while not pid_file.exists() or not pid_file.read_text():
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    with patch("snaketool_utils.cli_utils.build_snakemake_command", return_value=command):
+        asyncio.run(asyncio.wait_for(cancel_run(), 30))
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+
+
+FAKE_SNAKEMAKE = """#!{python}
+import json, os, sys, time
+args = sys.argv[1:]
+start = time.time()
+print("fake snakemake", *args, file=sys.stderr)
+if "--sleep" in args:
+    time.sleep(float(args[args.index("--sleep") + 1]))
+if "--jobs" in args:
+    jobs = int(args[args.index("--jobs") + 1])
+    for job in range(1, jobs + 1):
+        print(f"\\nrule step:\\n    jobid: {{job}}", file=sys.stderr, flush=True)
+        print(f"Finished job {{job}}.", file=sys.stderr)
+        print(f"{{job}} of {{jobs}} steps ({{100 * job // jobs}}%) done", file=sys.stderr, flush=True)
+        time.sleep(0.05)
+with open(os.environ["FAKE_SNAKEMAKE_RECORD"], "a") as f:
+    f.write(json.dumps({{"args": args, "start": start, "end": time.time()}}) + "\\n")
+sys.exit(1 if "--fail" in args else 0)
+"""
+
+
+@pytest.fixture(scope="function")
+def fake_snakemake(tmp_path, monkeypatch):
+    """Stub snakemake executable on PATH that records its arguments and run times"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    snakemake = bin_dir / "snakemake"
+    snakemake.write_text(FAKE_SNAKEMAKE.format(python=sys.executable))
+    snakemake.chmod(0o755)
+    record = tmp_path / "snakemake_calls.jsonl"
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FAKE_SNAKEMAKE_RECORD", str(record))
+
+    def calls():
+        if not record.exists():
+            return []
+        return [json.loads(line) for line in record.read_text().splitlines()]
+
+    return calls
+
+
+def test_run_snakemake_batch(capfd, fake_snakemake):
+    runs = [
+        {"snakefile_path": "Snakefile1", "threads": 2, "snake_args": ["--sleep", "0.5"]},
+        {"snakefile_path": "Snakefile2", "threads": 3, "snake_args": ["--sleep", "0.5", "--fail"]},
+        {"snakefile_path": "Snakefile3", "snake_args": ["--sleep", "0.2"]},
+        {"snakefile_path": "Snakefile4", "threads": 8},
+        {"snakefile_path": "Snakefile5", "threads": "auto"},
+    ]
+    results = run_snakemake_batch(runs, cores=4)
+    assert [result.returncode for result in results] == [0, 1, 0, 0, 0]
+    assert [result.spec for result in results] == runs
+    assert all(result.elapsed > 0 for result in results)
+    # runs get the threads they ask for (capped at the budget), 1 by default, or a share of the budget for "auto"
+    assert [result.threads for result in results] == [2, 3, 1, 4, 1]
+
+    # the core budget is never exceeded by concurrent runs
+    calls = fake_snakemake()
+    assert len(calls) == 5
+    cores = {run["args"][1]: int(run["args"][run["args"].index("--cores") + 1]) for run in calls}
+    assert cores == {"Snakefile1": 2, "Snakefile2": 3, "Snakefile3": 1, "Snakefile4": 4, "Snakefile5": 1}
+    for run in calls:
+        concurrent = [other for other in calls if other["start"] <= run["start"] < other["end"]]
+        assert sum(cores[other["args"][1]] for other in concurrent) <= 4
+
+
+def test_run_snakemake_batch_errors(capfd, tmp_path, fake_snakemake):
+    runs = [
+        {"snakefile_path": "Snakefile1"},
+        {"snakefile_path": "Snakefile2", "log": LogSink(tmp_path / "log.txt")},
+        {"snakefile_path": "Snakefile3"},
+    ]
+    results = run_snakemake_batch(runs, cores=2)
+    assert [result.returncode for result in results] == [0, 1, 0]
+    assert "ERROR: Run 2 of 3 failed: TypeError" in capfd.readouterr().err
+    assert len(fake_snakemake()) == 2
+
+
+def test_run_snakemake_report(capfd, tmp_path, fake_snakemake, left_path, right_config):
+    log_file = tmp_path / "run.log"
+    run_snakemake(
+        configfile=str(tmp_path / "config.yaml"),
+        system_config=str(left_path),
+        snakefile_path="Snakefile",
+        merge_config=right_config,
+        snake_args=["--sleep", "0.1"],
+        log=str(log_file),
+    )
+    assert run_report_path(str(log_file)) == str(tmp_path / "run.report.json")
+    with open(tmp_path / "run.report.json") as f:
+        report = json.load(f)
+    assert report["command"][0] == "snakemake"
+    assert report["returncode"] == 0
+    assert report["wall_time"] >= report["phases"]["snakemake"] >= 0.1
+    assert report["user_time"] >= 0
+    assert report["system_time"] >= 0
+    assert report["max_rss_bytes"] > 0
+    assert set(report["phases"]) == {"config_copy", "config_display", "snakemake"}
+
+    # a larger earlier child of this process isn't counted against the run
+    subprocess.run([sys.executable, "-c", "x = bytearray(200 * 1024 * 1024)"], check=True)
+    run_snakemake(configfile=str(tmp_path / "config.yaml"), snakefile_path="Snakefile", log=str(log_file))
+    with open(tmp_path / "run.report.json") as f:
+        assert 0 < json.load(f)["max_rss_bytes"] < 100 * 1024 * 1024
+
+
+def test_run_snakemake_structured_log(capfd, tmp_path, fake_snakemake, left_path, monkeypatch):
+    monkeypatch.setenv("SNAKETOOL_LOG_FORMAT", "json")
+    log_file = tmp_path / "run.log"
+    configfile = str(tmp_path / "config.yaml")
+    run_snakemake(configfile=configfile, system_config=str(left_path), snakefile_path="Snakefile", log=str(log_file))
+    events = [json.loads(line) for line in log_file.read_text().splitlines()]
+    by_event = {event["event"]: event for event in events}
+    assert by_event["config_copy"]["config"] == configfile
+    assert by_event["runtime_config"]["config"] == configfile
+    assert by_event["command"]["command"][:3] == ["snakemake", "-s", "Snakefile"]
+    assert by_event["output"]["stream"] == "stderr"
+    assert by_event["finished"]["returncode"] == 0
+    assert len({event["run_id"] for event in events}) == 1
+    assert "| Snakemake command |" in capfd.readouterr().err
+
+
+def test_progress_monitor(tmp_path):
+    status_file = tmp_path / "status.json"
+    prometheus_file = tmp_path / "snaketool.prom"
+    monitor = ProgressMonitor(prometheus_file=str(prometheus_file), status_file=str(status_file), interval=7200)
+    start = monitor.start_time
+    monitor.feed("Building DAG of jobs...\nJob stats:\n", now=start)
+    for job in range(1, 5):
+        monitor.feed(f"\nrule map:\n    jobid: {job}\n", now=start + job * 360)
+        # progress lines can arrive split across reads
+        monitor.feed(f"Finished job {job}.\n{job} of 10 st", now=start + job * 360)
+        monitor.feed("eps (10%) done\n", now=start + job * 360)
+    monitor.feed("Error in rule map:\n    jobid: 5\n", now=start + 1800)
+
+    status = monitor.status(now=start + 1800)
+    assert (status["done"], status["total"], status["percent"]) == (4, 10, 40)
+    assert (status["jobs_started"], status["jobs_finished"], status["errors"]) == (4, 4, 1)
+    assert status["jobs_per_hour"] == pytest.approx(8)
+    assert status["eta_seconds"] == pytest.approx(6 * 3600 / 8)
+
+    # only the first output was written within the interval, then everything when closed
+    assert json.loads(status_file.read_text())["done"] == 0
+    monitor.close()
+    status = json.loads(status_file.read_text())
+    assert not status["running"] and status["done"] == 4
+    metrics = dict(
+        line.split(" ", 1) for line in prometheus_file.read_text().splitlines() if not line.startswith("#")
+    )
+    labels = f'{{run_id="{status["run_id"]}"}}'
+    assert metrics[f"snaketool_jobs_done{labels}"] == "4"
+    assert metrics[f"snaketool_jobs_total{labels}"] == "10"
+    assert metrics[f"snaketool_job_errors_total{labels}"] == "1"
+    assert metrics[f"snaketool_running{labels}"] == "0"
+    assert sorted(os.listdir(tmp_path)) == ["snaketool.prom", "status.json"]
+
+
+def test_progress_monitor_unwritable(capfd, tmp_path):
+    status_file = tmp_path / "missing" / "status.json"
+    monitor = ProgressMonitor(status_file=str(status_file), interval=0)
+    # far more output than a pipe buffer holds, so the command blocks if its output stops being read
+    script = "import sys\nfor i in range(20000):\n    print(f'{i} of 20000 steps (0%) done', file=sys.stderr)"
+    assert run_command([sys.executable, "-c", script], monitor=monitor) == 0
+    assert "19999 of 20000 steps" in capfd.readouterr().err
+    assert monitor.done == 19999
+    monitor.close()
+    assert isinstance(monitor.write_error, OSError)
+    assert capfd.readouterr().err.count("WARNING: Couldn't write progress metrics") == 1
+    assert not status_file.parent.exists()
+
+
+def test_run_snakemake_progress(capfd, tmp_path, fake_snakemake):
+    status_file = tmp_path / "status.json"
+    prometheus_file = tmp_path / "snaketool.prom"
+    run_snakemake(
+        snakefile_path="Snakefile",
+        snake_args=["--jobs", "5"],
+        progress_status=str(status_file),
+        progress_prometheus=str(prometheus_file),
+        progress_interval=0,
+    )
+    status = json.loads(status_file.read_text())
+    assert (status["done"], status["total"], status["jobs_finished"]) == (5, 5, 5)
+    assert status["jobs_per_hour"] > 0
+    assert status["eta_seconds"] == 0
+    assert "snaketool_jobs_done" in prometheus_file.read_text()
+    # output is still shown while being monitored
+    assert "5 of 5 steps (100%) done" in capfd.readouterr().err
+
+
+def test_workflow_files(tmp_path):
+    (tmp_path / "rules").mkdir()
+    (tmp_path / "Snakefile").write_text('include: "rules/a.smk"\nrule all:\n    input: "x"\n')
+    (tmp_path / "rules" / "a.smk").write_text("include: 'b.smk'\n")
+    (tmp_path / "rules" / "b.smk").write_text("include: 'a.smk'\n")
+    assert workflow_files(str(tmp_path / "Snakefile")) == [
+        str(tmp_path / "Snakefile"), str(tmp_path / "rules" / "a.smk"), str(tmp_path / "rules" / "b.smk")
+    ]
+
+
+def test_run_snakemake_conda_prewarm(capfd, tmp_path, fake_snakemake):
+    (tmp_path / "envs").mkdir()
+    (tmp_path / "envs" / "tools.yaml").write_text("dependencies:\n  - samtools\n")
+    snakefile = tmp_path / "Snakefile"
+    snakefile.write_text('rule a:\n    conda:\n        "envs/tools.yaml"\n')
+    assert conda_env_files(str(snakefile)) == [str(tmp_path / "envs" / "tools.yaml")]
+    run_args = dict(
+        snakefile_path=str(snakefile), use_conda=True, conda_prefix=str(tmp_path / "conda"), conda_prewarm=True
+    )
+
+    def create_envs_calls():
+        return ["--conda-create-envs-only" in call["args"] for call in fake_snakemake()]
+
+    run_snakemake(**run_args)
+    assert create_envs_calls() == [True, False]
+    assert (tmp_path / "conda" / ".snaketool_envs.json").exists()
+    run_snakemake(**run_args)
+    assert create_envs_calls() == [True, False, False]
+    assert "conda environments already exist" in capfd.readouterr().err
+
+    (tmp_path / "envs" / "tools.yaml").write_text("dependencies:\n  - samtools=1.17\n")
+    run_snakemake(**run_args)
+    assert create_envs_calls() == [True, False, False, True, False]
+
+
+def test_run_snakemake_sharded(capfd, tmp_path, fake_snakemake):
+    log_file = tmp_path / "run.log"
+    run_args = dict(snakefile_path="Snakefile", batch_rule="aggregate", batches=4, batch_concurrency=3)
+    run_snakemake(**run_args, threads=7, snake_args=["--sleep", "0.2"], log=str(log_file))
+    calls = fake_snakemake()
+    batches = [call["args"][call["args"].index("--batch") + 1] for call in calls]
+    assert sorted(batches[:3]) == ["aggregate=1/4", "aggregate=2/4", "aggregate=3/4"]
+    assert batches[3] == "aggregate=4/4"
+    # the concurrent batches share the cores, and the final batch gets them all
+    cores = [call["args"][call["args"].index("--cores") + 1] for call in calls]
+    assert cores == ["2", "2", "2", "7"]
+    # the first three batches run concurrently, the final batch after they have all finished
+    assert max(call["start"] for call in calls[:3]) < min(call["end"] for call in calls[:3])
+    assert calls[3]["start"] >= max(call["end"] for call in calls[:3])
+
+    log_content = log_file.read_text()
+    for batch in range(1, 5):
+        assert f"==> batch {batch} of 4 for rule aggregate (exit code 0) <==" in log_content
+        assert f"--batch aggregate={batch}/4" in log_content
+    assert log_content.index("==> batch 1 of 4") < log_content.index("==> batch 4 of 4")
+    assert not list(tmp_path.glob("run.batch*.log"))
+
+    with pytest.raises(SystemExit):
+        run_snakemake(**run_args, snake_args=["--fail"])
+    assert len(fake_snakemake()) == 7
+    assert "Not running the final batch" in capfd.readouterr().err
+
+
+def test_run_snakemake_skip_unchanged(capfd, tmp_path, fake_snakemake, left_path):
+    snakefile = tmp_path / "Snakefile"
+    snakefile.write_text('include: "rules.smk"\n')
+    (tmp_path / "rules.smk").write_text("rule all:\n")
+    run_args = dict(
+        configfile=str(tmp_path / "config.yaml"),
+        system_config=str(left_path),
+        snakefile_path=str(snakefile),
+        skip_unchanged=True,
+    )
+
+    run_snakemake(**run_args)
+    assert (tmp_path / ".snaketool_fingerprint.json").exists()
+    run_snakemake(**run_args)
+    assert len(fake_snakemake()) == 1
+    assert "skipping Snakemake" in capfd.readouterr().err
+
+    # changes to included rules, the command, and forcing all rerun Snakemake
+    (tmp_path / "rules.smk").write_text("rule all:\n    input: 'x'\n")
+    run_snakemake(**run_args)
+    assert len(fake_snakemake()) == 2
+    run_snakemake(**run_args, threads=2)
+    assert len(fake_snakemake()) == 3
+    run_snakemake(**run_args, threads=2, force_run=True)
+    assert len(fake_snakemake()) == 4
+
+    # a failed run is never skipped
+    with pytest.raises(SystemExit):
+        run_snakemake(**run_args, threads=2, snake_args=["--fail"])
+    assert not (tmp_path / ".snaketool_fingerprint.json").exists()
+    run_snakemake(**run_args, threads=2)
+    assert len(fake_snakemake()) == 6
+
+
+@pytest.fixture(scope="function")
+def cgroup_v2(tmp_path):
+    root = tmp_path / "cgroup"
+    job = root / "slurm" / "job_1"
+    job.mkdir(parents=True)
+    (root / "slurm" / "cpu.max").write_text("800000 100000\n")
+    (root / "slurm" / "memory.max").write_text("max\n")
+    (job / "cpu.max").write_text("250000 100000\n")
+    (job / "memory.max").write_text(str(4 * 2**30) + "\n")
+    proc = tmp_path / "proc_cgroup"
+    proc.write_text("0::/slurm/job_1\n")
+    return str(root), str(proc)
+
+
+@pytest.fixture(scope="function")
+def cgroup_v1(tmp_path):
+    root = tmp_path / "cgroup"
+    cpu = root / "cpu,cpuacct" / "docker" / "abc"
+    memory = root / "memory" / "docker" / "abc"
+    cpu.mkdir(parents=True)
+    memory.mkdir(parents=True)
+    (cpu / "cpu.cfs_quota_us").write_text("300000\n")
+    (cpu / "cpu.cfs_period_us").write_text("100000\n")
+    (memory / "memory.limit_in_bytes").write_text(str(2 * 2**30) + "\n")
+    (root / "memory" / "memory.limit_in_bytes").write_text("9223372036854771712\n")
+    proc = tmp_path / "proc_cgroup"
+    proc.write_text("12:memory:/docker/abc\n4:cpu,cpuacct:/docker/abc\n0::/\n")
+    return str(root), str(proc)
+
+
+def test_cgroup_v2_limits(cgroup_v2):
+    assert cgroup_cpu_limit(*cgroup_v2) == 2.5
+    assert cgroup_memory_limit(*cgroup_v2) == 4 * 2**30
+    assert available_memory_mb(*cgroup_v2) == 4096
+    with patch("os.sched_getaffinity", return_value={0, 1, 2, 3}, create=True):
+        assert available_cores(*cgroup_v2) == 2
+
+
+def test_cgroup_v1_limits(cgroup_v1):
+    assert cgroup_cpu_limit(*cgroup_v1) == 3
+    assert available_memory_mb(*cgroup_v1) == 2048
+    with patch("os.sched_getaffinity", return_value={0, 1}, create=True):
+        assert available_cores(*cgroup_v1) == 2
+
+
+def test_cgroup_no_limits(tmp_path):
+    assert cgroup_cpu_limit(str(tmp_path), str(tmp_path / "missing")) is None
+    assert available_memory_mb(str(tmp_path), str(tmp_path / "missing")) is None
+    assert available_cores(str(tmp_path), str(tmp_path / "missing")) >= 1
+
+
+def test_build_snakemake_command_auto_resources():
+    with patch("snaketool_utils.cli_utils.available_cores", return_value=6), patch(
+        "snaketool_utils.cli_utils.available_memory_mb", return_value=2048
+    ):
+        command = build_snakemake_command(snakefile_path="Snakefile", threads="auto", mem_mb="auto")
+    assert command == ["snakemake", "-s", "Snakefile", "--cores", "6", "--resources", "mem_mb=2048"]
+
+
 def test_tuple_to_list_single_tuple():
     input_dict = {'a': (1, 2, 3)}
     expected_output = {'a': [1, 2, 3]}
@@ -433,4 +1617,237 @@ def test_tuple_to_list_empty_dict():
 def test_tuple_to_list_mixed_types():
     input_dict = {'a': (1, 2, 3), 'b': 'string', 'c': {'d': (4, 5)}, 'e': 6}
     expected_output = {'a': [1, 2, 3], 'b': 'string', 'c': {'d': [4, 5]}, 'e': 6}
-    assert tuple_to_list(input_dict) == expected_output
\ No newline at end of file
+    assert tuple_to_list(input_dict) == expected_output
+
+
+def test_tuple_to_list_in_lists():
+    input_dict = {'a': [(1, 2), {'b': (3,)}], 'c': ((4, (5,)),)}
+    output = tuple_to_list(input_dict)
+    assert output == {'a': [[1, 2], {'b': [3]}], 'c': [[4, [5]]]}
+    assert type(output['c'][0][1]) is list
+    assert input_dict == {'a': [(1, 2), {'b': (3,)}], 'c': ((4, (5,)),)}
+
+
+def test_tuple_to_list_deep():
+    deep = current = {}
+    for _ in range(5000):
+        current['k'] = current = {}
+    current['leaf'] = (1,)
+    output = tuple_to_list(deep)
+    for _ in range(5000):
+        output = output['k']
+    assert output == {'leaf': [1]}
+
+
+@pytest.mark.parametrize("backend", ["python", "libyaml"])
+def test_config_dumper(tmp_path, monkeypatch, backend):
+    import enum
+    import pathlib
+    import yaml
+
+    if backend == "libyaml" and not yaml.__with_libyaml__:
+        pytest.skip("PyYAML not built with LibYAML")
+    monkeypatch.setenv("SNAKETOOL_YAML_BACKEND", backend)
+    Mode = enum.Enum("Mode", ["fast", "sensitive"])
+    config = {
+        "reads": ("a.fq", "b.fq"),
+        "nested": [("x", 1), {"y": (pathlib.Path("out") / "dir",)}],
+        "outdir": pathlib.Path("results"),
+        "mode": Mode.fast,
+    }
+    assert issubclass(config_dumper(), yaml_backend()[1])
+    assert config_dumper() is config_dumper()
+    file_path = tmp_path / "config.yaml"
+    with patch("snaketool_utils.cli_utils.tuple_to_list") as mock_tuple_to_list:
+        write_config(config, file_path)
+        mock_tuple_to_list.assert_not_called()
+    expected = {
+        "reads": ["a.fq", "b.fq"],
+        "nested": [["x", 1], {"y": [os.path.join("out", "dir")]}],
+        "outdir": "results",
+        "mode": "fast",
+    }
+    assert read_config(file_path) == expected
+    assert config_fingerprint(config) == config_fingerprint(expected)
+    # plain safe dumpers can't represent these types
+    with pytest.raises(yaml.representer.RepresenterError):
+        yaml.dump(config, Dumper=yaml_backend()[1])
+
+
+def test_sample_table(tmp_path):
+    table_path = tmp_path / "samples.tsv"
+    table_path.write_text("sample\tR1\tR2\nA\ta_1.fq\ta_2.fq\n\nB\tb_1.fq\t\nC\t\"c 1.fq\"\tc_2.fq\n")
+    table = SampleTable(table_path)
+    assert os.fspath(table) == str(table_path)
+    assert table.columns == ["sample", "R1", "R2"]
+    assert table.samples == ["A", "B", "C"]
+    assert len(table) == 3 and "B" in table and "D" not in table
+    assert table.row("C") == {"sample": "C", "R1": "c 1.fq", "R2": "c_2.fq"}
+    assert table["B"]["R2"] == ""
+
+    # a new SampleTable reuses the cached index until the table changes
+    assert os.path.isfile(table.index_path)
+    with patch.object(SampleTable, "_parse", side_effect=AssertionError("re-parsed")):
+        assert SampleTable(table_path).samples == ["A", "B", "C"]
+    with open(table_path, "a") as stream:
+        stream.write("D\td_1.fq\td_2.fq\n")
+    assert SampleTable(table_path).samples == ["A", "B", "C", "D"]
+
+    csv_path = tmp_path / "samples.csv"
+    csv_path.write_text("id,name\n1,one\n2,two\n")
+    assert SampleTable(csv_path, index_column="name").row("two") == {"id": "2", "name": "two"}
+
+
+@pytest.mark.parametrize(
+    "content,error",
+    [
+        ("sample\tR1\nA\ta.fq\nA\tb.fq\n", "line 3: duplicate sample A"),
+        ("sample\tR1\nA\ta.fq\tb.fq\n", "line 2: 3 columns, expected 2"),
+        ("sample\tR1\n\tb.fq\n", "line 2: empty sample"),
+        ("sample\tsample\n", "duplicate column names"),
+        ("sample\t\n", "must name every column"),
+        ('sample\tR1\nA\t"a\n.fq"\n', "quoted fields can't span lines"),
+        ("sample\tR1\nA\ta.fq\n", "no name column"),
+    ],
+)
+def test_sample_table_validation(tmp_path, content, error):
+    table_path = tmp_path / "samples.tsv"
+    table_path.write_text(content)
+    with pytest.raises(ValueError, match=error):
+        SampleTable(table_path, index_column="name" if "name" in error else None).index()
+
+
+def test_run_snakemake_sample_table(capfd, tmp_path, fake_snakemake, left_path, left_config):
+    table_path = tmp_path / "samples.tsv"
+    table_path.write_text("sample\tR1\n" + "".join(f"S{i}\tS{i}.fq\n" for i in range(1000)))
+    configfile = tmp_path / "config.yaml"
+    merge = {"samples": SampleTable(table_path), "nested": [{"more": SampleTable(table_path)}]}
+    assert sample_tables(merge) == [SampleTable(table_path), SampleTable(table_path)]
+    run_snakemake(
+        configfile=str(configfile),
+        system_config=str(left_path),
+        snakefile_path="Snakefile",
+        merge_config=merge,
+        log=str(tmp_path / "run.log"),
+    )
+    assert read_config(configfile) == dict(left_config, samples=str(table_path), nested=[{"more": str(table_path)}])
+    captured = capfd.readouterr().err
+    assert "with 1000 samples" in captured
+    # the runtime config shows the path written to the config file
+    assert f"samples: {table_path}\n" in captured
+    with open(tmp_path / "run.report.json") as stream:
+        assert "sample_tables" in json.load(stream)["phases"]
+
+    table_path.write_text("sample\tR1\nS1\tS1.fq\nS1\tS1.fq\n")
+    with pytest.raises(SystemExit):
+        run_snakemake(
+            configfile=str(configfile),
+            system_config=str(left_path),
+            snakefile_path="Snakefile",
+            merge_config={"samples": SampleTable(table_path)},
+            log=str(tmp_path / "run.log"),
+        )
+    assert "ERROR: Invalid sample table" in capfd.readouterr().err
+    # the run report is still written before exiting
+    with open(tmp_path / "run.report.json") as stream:
+        assert json.load(stream)["returncode"] == 1
+    with pytest.raises(ValueError, match="Invalid sample table"):
+        build_snakemake_command(
+            configfile=str(configfile), snakefile_path="Snakefile", merge_config={"samples": SampleTable(table_path)}
+        )
+    result = asyncio.run(
+        async_run_snakemake(
+            configfile=str(configfile), snakefile_path="Snakefile", merge_config={"samples": SampleTable(table_path)}
+        )
+    )
+    assert (result.command, result.returncode) == (None, 1)
+    assert "ERROR: Invalid sample table" in capfd.readouterr().err
+
+
+def test_rotate_log(tmp_path):
+    import gzip
+
+    log_file = tmp_path / "run.log"
+    assert rotate_log(log_file) is None
+    log_file.write_text("first\n")
+    assert rotate_log(log_file, max_bytes=100) is None
+    segment = rotate_log(log_file, compress=False)
+    assert log_segments(log_file) == [segment]
+    assert not log_file.exists()
+    assert open(segment).read() == "first\n"
+
+    # only the newest segments are kept
+    for i in range(6):
+        log_file.write_text(f"run {i}\n")
+        rotate_log(log_file, keep=3, compress=False)
+    assert [open(path).read() for path in log_segments(log_file)] == ["run 3\n", "run 4\n", "run 5\n"]
+
+    # rotated segments are compressed in the background
+    log_file.write_text("compressed\n")
+    segment = rotate_log(log_file, keep=3, compress=True)
+    deadline = time.monotonic() + 10
+    while os.path.exists(segment) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert log_segments(log_file)[-1] == segment + ".gz"
+    with gzip.open(segment + ".gz", "rt") as stream:
+        assert stream.read() == "compressed\n"
+    assert len(log_segments(log_file)) == 3
+    assert sorted(os.listdir(tmp_path)) == [".run.log.lock"] + sorted(map(os.path.basename, log_segments(log_file)))
+
+
+def test_log_rotation_by_size(capsys, tmp_path, monkeypatch):
+    monkeypatch.setenv("SNAKETOOL_LOG_MAX_BYTES", "1000")
+    monkeypatch.setenv("SNAKETOOL_LOG_KEEP", "100")
+    log_file = tmp_path / "run.log"
+    for i in range(100):
+        msg(f"message {i}", log=log_file)
+    segments = log_segments(log_file)
+    assert len(segments) >= 3
+    assert all(1000 <= os.path.getsize(path) < 1100 for path in segments)
+    lines = "".join(open(path).read() for path in segments + [log_file]).splitlines()
+    assert [line.split("] ")[1] for line in lines] == [f"message {i}" for i in range(100)]
+
+    sink_log = tmp_path / "sink.log"
+    with LogSink(sink_log, flush_interval=0) as sink:
+        for i in range(100):
+            msg(f"message {i}", log=sink)
+        # another process rotates the log, and the sink carries on in the new log
+        rotate_log(sink_log, compress=False)
+        msg("after rotation", log=sink)
+    assert sink_log.read_text().endswith("] after rotation\n")
+    assert len(log_segments(sink_log)) >= 4
+
+
+def _concurrent_log_writer(barrier, results, log_file, worker):
+    barrier.wait()
+    with open(os.devnull, "w") as devnull, patch.object(sys, "stderr", devnull):
+        for i in range(200):
+            msg(f"worker {worker} message {i}", log=log_file)
+    results.put((worker, None, 0))
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="requires fcntl and fork")
+def test_log_rotation_concurrent(tmp_path, monkeypatch):
+    monkeypatch.setenv("SNAKETOOL_LOG_MAX_BYTES", "20000")
+    monkeypatch.setenv("SNAKETOOL_LOG_KEEP", "1000")
+    monkeypatch.setenv("SNAKETOOL_LOG_COMPRESS", "0")
+    log_file = tmp_path / "run.log"
+    _run_concurrently(_concurrent_log_writer, (str(log_file),), n_workers=8)
+
+    # every message is in exactly one segment or the log
+    lines = []
+    for path in log_segments(log_file) + [log_file]:
+        lines.extend(line.split("] ", 1)[1] for line in open(path).read().splitlines())
+    expected = [f"worker {worker} message {i}" for worker in range(8) for i in range(200)]
+    assert sorted(lines) == sorted(expected)
+    assert len(log_segments(log_file)) >= 3
+
+
+def test_run_snakemake_log_per_run(capfd, tmp_path, fake_snakemake):
+    log_file = tmp_path / "run.log"
+    for run in range(2):
+        run_snakemake(snakefile_path=f"Snakefile{run}", log=str(log_file), log_per_run=True)
+    segments = log_segments(log_file)
+    assert len(segments) == 1
+    assert "Snakefile0" in open(segments[0]).read()
+    assert "Snakefile0" not in log_file.read_text() and "Snakefile1" in log_file.read_text()